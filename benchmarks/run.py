@@ -0,0 +1,210 @@
+"""Benchmark get_results against the local mock API (see benchmarks.server).
+
+Each scenario runs in its own process so that peak memory usage (RSS) is
+measured separately. For each endpoint class the scenarios are:
+
+- fetch: download all results without cache,
+- cache-write: download and store results in an empty cache,
+- cache-read: read the same results from the cache, without API requests.
+
+    python -m benchmarks.run --days 7 --keys 20 --latency 0.02 --json results.jsonl
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import ujson as json
+from requests_futures.sessions import FuturesSession
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ENDPOINTS = ("hegemony", "delay", "forwarding", "disco")
+SCENARIOS = ("fetch", "cache-write", "cache-read")
+
+
+class TimingSession(FuturesSession):
+    """FuturesSession recording the latency of each request."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def request(self, *args, **kwargs):
+        sent = time.perf_counter()
+        future = super().request(*args, **kwargs)
+        future.add_done_callback(
+            lambda _: self.latencies.append(time.perf_counter() - sent))
+        return future
+
+
+def client(endpoint, url, spec, session, cache):
+    """Return the client of the given endpoint for the benchmark spec."""
+
+    # Windows are inclusive: ending at 00:00 of the next day would also query
+    # its first timebin, a day that is never complete and so never cached
+    start = "2018-09-01"
+    end = "2018-09-{:02d}T23:59:59".format(spec["days"])
+    keys = list(range(1, spec["keys"] + 1))
+    kwargs = dict(start=start, end=end, session=session, cache=cache,
+                  cache_dir=spec["cache_dir"], cache_backend=spec["backend"],
+                  nb_threads=spec["threads"], max_threads=spec["threads"])
+
+    if endpoint == "hegemony":
+        from ihr.hegemony import Hegemony
+        return Hegemony(originasns=keys, url=url + "hegemony/", **kwargs)
+    if endpoint == "delay":
+        from ihr.link_delay import Delay
+        return Delay(asns=keys, url=url + "link/delay/", **kwargs)
+    if endpoint == "forwarding":
+        from ihr.link_forwarding import Forwarding
+        return Forwarding(asns=keys, url=url + "link/forwarding/", **kwargs)
+
+    from ihr.disco_events import Disconnect
+    streamnames = ["C{}".format(key) for key in keys]
+    return Disconnect(streamnames=streamnames, url=url + "disco/events/", **kwargs)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def peak_rss():
+    """Peak resident memory of the process in MB."""
+
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def run_scenario(spec):
+    """Run a single scenario and return its measurements."""
+
+    from ihr import memory
+
+    # Measure the disk cache, not the memory cache
+    memory.cache.resize(0)
+    session = TimingSession(max_workers=spec["threads"])
+    cache = spec["scenario"] != "fetch"
+    api = client(spec["endpoint"], spec["url"], spec, session, cache)
+
+    started = time.perf_counter()
+    records = 0
+    for results in api.get_results(batch_size=spec["batch_size"]):
+        records += len(results)
+    elapsed = time.perf_counter() - started
+
+    pages = len(session.latencies)
+    if spec["scenario"] == "cache-read" and pages:
+        raise RuntimeError("cache-read sent {} API requests, results are not all "
+                           "cached".format(pages))
+    p50 = percentile(session.latencies, 0.5)
+    p99 = percentile(session.latencies, 0.99)
+    return {
+        "endpoint": spec["endpoint"],
+        "scenario": spec["scenario"],
+        "backend": spec["backend"],
+        "records": records,
+        "seconds": round(elapsed, 3),
+        "records_per_s": round(records / elapsed, 1) if elapsed else None,
+        "pages": pages,
+        "pages_per_s": round(pages / elapsed, 1) if elapsed else None,
+        "p50_ms": round(1000 * p50, 2) if p50 is not None else None,
+        "p99_ms": round(1000 * p99, 2) if p99 is not None else None,
+        "peak_rss_mb": round(peak_rss(), 1) if resource is not None else None,
+    }
+
+
+def run(spec):
+    """Run a scenario in a child process, return its measurements."""
+
+    proc = subprocess.run(
+        [sys.executable, "-m", "benchmarks.run", "--child", json.dumps(spec)],
+        stdout=subprocess.PIPE, check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return json.loads(proc.stdout.decode("utf-8").splitlines()[-1])
+
+
+def report(results):
+    columns = ("endpoint", "scenario", "backend", "records", "records_per_s",
+               "pages", "pages_per_s", "p50_ms", "p99_ms", "peak_rss_mb")
+    rows = [columns] + [tuple("-" if res[name] is None else str(res[name])
+                              for name in columns) for res in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--endpoints", nargs="+", default=ENDPOINTS, choices=ENDPOINTS)
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--backends", nargs="+", default=["json"],
+                        choices=("json", "binary", "sqlite"),
+                        help="cache backends of the cache scenarios")
+    parser.add_argument("--days", type=int, default=3, help="days per query (1-30)")
+    parser.add_argument("--keys", type=int, default=10, help="ASNs (or countries) per query")
+    parser.add_argument("--threads", type=int, default=8, help="concurrent requests")
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="API response time in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--dependencies", type=int, default=20,
+                        help="hegemony results per origin AS and timebin")
+    parser.add_argument("--gzip", action="store_true", help="compress API responses")
+    parser.add_argument("--url", help="use a running API instead of the mock API")
+    parser.add_argument("--json", help="append results to this file (JSON lines)")
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(json.loads(args.child))))
+        return
+
+    from benchmarks.server import Config, serve
+
+    url = args.url
+    if url is None:
+        config = Config(args.page_size, args.latency, args.jitter, args.error_rate,
+                        args.dependencies, compress=args.gzip)
+        server, url = serve(config)
+
+    results = []
+    cache_dir = tempfile.mkdtemp(prefix="abondance-bench-")
+    try:
+        for endpoint in args.endpoints:
+            for backend in args.backends:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                for scenario in args.scenarios:
+                    if scenario == "fetch" and backend != args.backends[0]:
+                        continue
+                    spec = dict(endpoint=endpoint, scenario=scenario, backend=backend,
+                                url=url, cache_dir=cache_dir, days=args.days,
+                                keys=args.keys, threads=args.threads,
+                                batch_size=args.batch_size)
+                    results.append(run(spec))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    report(results)
+    if args.json:
+        run_info = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "args": vars(args)}
+        with open(args.json, "a") as fp:
+            for res in results:
+                fp.write(json.dumps(dict(res, **run_info)) + "\n")
+
+
+if __name__ == "__main__":
+    main()
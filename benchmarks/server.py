@@ -0,0 +1,263 @@
+"""Local stand-in for the IHR API, serving generated results.
+
+Results are generated deterministically from the query parameters so that
+repeated queries return the same pages. The number of results, the page size,
+the response latency and the error rate are configurable.
+
+    python -m benchmarks.server --port 8000 --latency 0.05 --error-rate 0.01
+"""
+import gzip
+import time
+import zlib
+import random
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+import ujson as json
+
+# Time resolution of each endpoint
+STEPS = {
+    "hegemony": timedelta(minutes=15),
+    "delay": timedelta(hours=1),
+    "forwarding": timedelta(hours=1),
+    "disco": timedelta(hours=6),
+}
+
+
+class Config():
+    """Settings of the mock API, shared by all request handlers."""
+
+    def __init__(self, page_size=100, latency=0.0, jitter=0.0, error_rate=0.0,
+                 dependencies=20, seed=0, compress=False):
+        """
+        :page_size: Number of results per page.
+        :latency: Time to answer a request in seconds.
+        :jitter: Random latency added to each request, up to jitter seconds.
+        :error_rate: Fraction of requests answered with an error (503 or 429).
+        :dependencies: Number of dependencies per origin AS for hegemony
+        queries without asn, i.e. results per timebin.
+        :compress: Gzip responses if the client accepts it.
+        """
+
+        self.page_size = page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.dependencies = dependencies
+        self.compress = compress
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+
+def parse_time(value):
+    """Parse API date/time parameters (ISO format)."""
+
+    value = value.replace(" ", "+").replace("Z", "+00:00")
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def format_time(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def values(query, name):
+    """Return the list of integer values of a (comma separated) parameter,
+    [None] if it is not given."""
+
+    value = query.get(name, [""])[0]
+    if not value:
+        return [None]
+    return [int(v) for v in value.split(",")]
+
+
+def noise(*args):
+    """Deterministic pseudo-random number in [0, 1) for the given values."""
+
+    return zlib.crc32(repr(args).encode("utf-8")) / 2**32
+
+
+def timebins(query, step, field="timebin"):
+    """Yield the timebins between the __gte and __lte parameters."""
+
+    start = parse_time(query[field + "__gte"][0])
+    end = parse_time(query[field + "__lte"][0])
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    t = epoch + step * -(-(start - epoch) // step)
+    while t <= end:
+        yield t
+        t += step
+
+
+def hegemony(query, config):
+    results = []
+    af = int(query.get("af", ["4"])[0])
+    for t in timebins(query, STEPS["hegemony"]):
+        timebin = format_time(t)
+        for origin in values(query, "originasn"):
+            origin = origin if origin is not None else 0
+            asns = values(query, "asn")
+            if asns == [None]:
+                asns = [origin] + [174 + 10 * i for i in range(config.dependencies - 1)]
+            for asn in asns:
+                results.append({
+                    "timebin": timebin, "originasn": origin, "asn": asn,
+                    "hege": round(noise(timebin, origin, asn), 4), "af": af,
+                    "asn_name": "AS{} Example Network".format(asn),
+                    "originasn_name": "AS{} Example Network".format(origin),
+                })
+    return results
+
+
+def link(query, config, endpoint):
+    results = []
+    af = int(query.get("af", ["4"])[0])
+    for t in timebins(query, STEPS[endpoint]):
+        timebin = format_time(t)
+        for asn in values(query, "asn"):
+            results.append({
+                "timebin": timebin, "asn": asn, "af": af,
+                "magnitude": round(10 * noise(endpoint, timebin, asn), 3),
+                "asn_name": "AS{} Example Network".format(asn),
+                "link": "192.0.2.1-198.51.100.{}".format(asn % 256 if asn else 0),
+            })
+    return results
+
+
+def disco(query, config):
+    results = []
+    start = parse_time(query["starttime__gte"][0])
+    end = parse_time(query["starttime__lte"][0])
+    streamname = query.get("streamname", ["JP"])[0]
+    for t in timebins({"starttime__gte": [format_time(start)],
+                       "starttime__lte": [format_time(end)]},
+                      STEPS["disco"], "starttime"):
+        duration = timedelta(minutes=10 + int(100 * noise(streamname, t)))
+        results.append({
+            "id": int(t.timestamp()), "streamname": streamname, "streamtype": "country",
+            "starttime": format_time(t), "endtime": format_time(t + duration),
+            "avglevel": round(5 * noise(t, streamname), 2),
+            "nbdiscoprobes": 3 + int(20 * noise(streamname, t, 1)),
+            "totalprobes": 100, "ongoing": None,
+        })
+    return results
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answer API queries with generated results (see Config)."""
+
+    config = Config()
+    # Keep connections alive like the API
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body=b"", headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        config = self.config
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        with config.lock:
+            config.requests += 1
+            delay = config.latency + config.random.random() * config.jitter
+            error = config.random.random() < config.error_rate
+            if error:
+                config.errors += 1
+                status = config.random.choice((503, 429))
+        time.sleep(delay)
+        if error:
+            self.send(status, headers=[("Retry-After", "0")])
+            return
+
+        path = url.path.rstrip("/")
+        try:
+            if path.endswith("/hegemony"):
+                results = hegemony(query, config)
+            elif path.endswith("/link/delay"):
+                results = link(query, config, "delay")
+            elif path.endswith("/link/forwarding"):
+                results = link(query, config, "forwarding")
+            elif path.endswith("/disco/events"):
+                results = disco(query, config)
+            else:
+                self.send(404)
+                return
+        except (KeyError, ValueError) as error:
+            self.send(400, json.dumps({"detail": str(error)}).encode("utf-8"))
+            return
+
+        page = int(query.get("page", ["1"])[0])
+        size = config.page_size
+        params = {name: value[0] for name, value in query.items()}
+        body = {
+            "count": len(results),
+            "next": None, "previous": None,
+            "results": results[(page - 1) * size:page * size],
+        }
+        if page * size < len(results):
+            body["next"] = "{}?{}".format(url.path, urlencode(dict(params, page=page + 1)))
+        if page > 1:
+            body["previous"] = "{}?{}".format(url.path, urlencode(dict(params, page=page - 1)))
+        body = json.dumps(body).encode("utf-8")
+        if config.compress and "gzip" in self.headers.get("Accept-Encoding", ""):
+            self.send(200, gzip.compress(body, 1), [("Content-Encoding", "gzip")])
+        else:
+            self.send(200, body)
+
+
+def serve(config=None, port=0):
+    """Start the mock API in a background thread.
+
+    :returns: The server and the API root url.
+    """
+
+    handler = type("Handler", (Handler,), {"config": config or Config()})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}/ihr/api/".format(server.server_address[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="response time in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="random latency added to each response, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--dependencies", type=int, default=20,
+                        help="hegemony results per origin AS and timebin")
+    parser.add_argument("--gzip", action="store_true", help="compress responses")
+    args = parser.parse_args()
+
+    config = Config(args.page_size, args.latency, args.jitter, args.error_rate,
+                    args.dependencies, compress=args.gzip)
+    server, url = serve(config, args.port)
+    print("Serving mock IHR API on {}".format(url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Benchmark the cold start of the library: import time and client creation.
+
+Each measure runs in a fresh interpreter, the interpreter startup (measured
+with an empty script) is subtracted. Heavy dependencies imported by the
+statement are also listed, none are expected before the first request.
+
+    python -m benchmarks.startup --repeat 20 --json startup.jsonl
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+import ujson as json
+
+HEAVY = ("arrow", "requests", "requests_futures", "urllib3", "ujson", "numpy")
+SCENARIOS = {
+    "import": "import ihr.hegemony, ihr.link_delay, ihr.link_forwarding, "
+              "ihr.disco_events",
+    "client": "from ihr.hegemony import Hegemony\n"
+              "Hegemony(originasns=2907, start='2018-09-15', end='2018-09-16', "
+              "cache_dir='startup-cache-does-not-exist')",
+}
+CHILD = """
+import sys, time
+started = time.perf_counter()
+{}
+elapsed = time.perf_counter() - started
+import json
+print(json.dumps([elapsed, [name for name in {!r} if name in sys.modules]]))
+"""
+
+
+def measure(statement):
+    """Run the statement in a new interpreter, return the wall time of the
+    process and (statement time, heavy modules imported)."""
+
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", CHILD.format(statement, HEAVY)],
+                          stdout=subprocess.PIPE, check=True,
+                          cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    wall = time.perf_counter() - started
+    elapsed, modules = json.loads(proc.stdout.decode("utf-8").splitlines()[-1])
+    return wall, elapsed, modules
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10, help="runs per scenario")
+    parser.add_argument("--json", help="append results to this file (JSON lines)")
+    args = parser.parse_args()
+
+    interpreter = median([measure("pass")[0] for _ in range(args.repeat)])
+    results = []
+    for scenario, statement in SCENARIOS.items():
+        runs = [measure(statement) for _ in range(args.repeat)]
+        results.append({
+            "scenario": scenario,
+            "ms": round(1000 * median([elapsed for _, elapsed, _ in runs]), 1),
+            "process_ms": round(1000 * (median([wall for wall, _, _ in runs])
+                                        - interpreter), 1),
+            "heavy_modules": ",".join(runs[-1][2]) or "-",
+        })
+
+    print("interpreter startup: {:.1f} ms".format(1000 * interpreter))
+    for res in results:
+        print("{scenario}: {ms} ms in process, {process_ms} ms wall, heavy modules: "
+              "{heavy_modules}".format(**res))
+
+    if args.json:
+        run_info = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "args": vars(args)}
+        with open(args.json, "a") as fp:
+            for res in results:
+                fp.write(json.dumps(dict(res, **run_info)) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+import sys
+from ihr.cli import main
+
+sys.exit(main())
@@ -0,0 +1,291 @@
+import os
+import hashlib
+import arrow
+import numpy as np
+import ujson as json
+from ihr import memory
+from ihr.cache import temporary
+
+DURATIONS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+REDUCTIONS = ("mean", "sum", "min", "max", "count", "first", "last", "median")
+# Number of rolling windows computed at once, bounds the memory of
+# min/max/median windows
+ROLLING_CHUNK = 2**16
+
+
+def seconds(duration):
+    """Return the number of seconds of a duration given in seconds or as a
+    string, e.g. "15m", "1h" or "1d"."""
+
+    if isinstance(duration, str):
+        unit = duration[-1].lower()
+        if unit in DURATIONS:
+            return int(float(duration[:-1]) * DURATIONS[unit])
+    return int(duration)
+
+
+def reduce(values, starts, how):
+    """Reduce consecutive groups of values starting at the given positions.
+
+    :values: Array of values.
+    :starts: Sorted array of the first position of each group, starting at 0.
+    :how: Reduction, one of REDUCTIONS.
+
+    :returns: Array of one value per group.
+    """
+
+    if how not in REDUCTIONS:
+        raise ValueError("Unknown reduction: {}".format(how))
+    if not len(starts):
+        return np.empty(0, dtype=np.float64)
+
+    counts = np.diff(np.append(starts, len(values)))
+    if how == "mean":
+        return np.add.reduceat(values, starts) / counts
+    if how == "sum":
+        return np.add.reduceat(values, starts)
+    if how == "min":
+        return np.minimum.reduceat(values, starts)
+    if how == "max":
+        return np.maximum.reduceat(values, starts)
+    if how == "count":
+        return counts.astype(np.float64)
+    if how == "first":
+        return values[starts]
+    if how == "last":
+        return values[starts + counts - 1]
+
+    # Median: sort values within each group, then take the middle ones
+    groups = np.repeat(np.arange(len(starts)), counts)
+    ordered = values[np.lexsort((values, groups))]
+    return (ordered[starts + (counts - 1) // 2] + ordered[starts + counts // 2]) / 2
+
+
+class TimeSeries():
+    """Time series of one field (e.g. magnitude) for each ASN.
+
+    Values of all ASNs are stored in flat numpy arrays sorted by ASN and time,
+    offsets give the range of each ASN. Resampling, rolling windows and
+    group-by reductions are computed for all ASNs at once with vectorized
+    numpy operations, and return new TimeSeries (or tables of arrays).
+
+        series = Delay(asns=[2907, 7922], start="2018-09-01",
+                       end="2018-09-30").get_series()
+        daily = series.resample("1d", "max")
+        smooth = series.rolling(24, "median")
+        peaks = series.groupby("asn", "max")
+    """
+
+    def __init__(self, asns, offsets, times, values, field="magnitude"):
+        """
+        :asns: Sorted array of ASNs.
+        :offsets: Position of the first value of each ASN, followed by the
+        number of values.
+        :times: datetime64[s] array of times, sorted for each ASN.
+        :values: float64 array of values.
+        :field: Name of the field.
+        """
+
+        self.asns = asns
+        self.offsets = offsets
+        self.times = times
+        self.values = values
+        self.field = field
+
+    @classmethod
+    def from_columns(cls, tables, field="magnitude"):
+        """Build time series from tables of numpy arrays with timebin, asn and
+        field arrays (see Client.iter_columns), or from the dictionary
+        returned by get_columns."""
+
+        if isinstance(tables, dict):
+            tables = tables.values()
+        tables = [table for table in tables if len(table["timebin"])]
+        if not tables:
+            return cls(np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64),
+                       np.empty(0, dtype="datetime64[s]"), np.empty(0), field)
+
+        asn = np.concatenate([table["asn"] for table in tables]).astype(np.int64)
+        times = np.concatenate([table["timebin"] for table in tables]).astype("datetime64[s]")
+        values = np.concatenate([table[field] for table in tables]).astype(np.float64)
+        order = np.lexsort((times, asn))
+        asn = asn[order]
+        asns, starts = np.unique(asn, return_index=True)
+        return cls(asns, np.append(starts, len(asn)), times[order], values[order], field)
+
+    @classmethod
+    def from_client(cls, client, field="magnitude", batch_size=None):
+        """Build time series from the results of a Delay or Forwarding client,
+        converted to arrays page by page (see iter_columns)."""
+
+        return cls.from_columns((table for _, table in client.iter_columns(batch_size=batch_size)),
+                                field)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, asn):
+        """Return the (times, values) arrays of the given ASN."""
+
+        position = np.searchsorted(self.asns, asn)
+        if position == len(self.asns) or self.asns[position] != asn:
+            raise KeyError(asn)
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return self.times[start:end], self.values[start:end]
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.asns, self.offsets, self.times, self.values))
+
+    def asn_numbers(self):
+        """Return the number of the ASN (position in self.asns) of each
+        value."""
+
+        return np.repeat(np.arange(len(self.asns)), np.diff(self.offsets))
+
+    def to_columns(self):
+        """Return a table of timebin, asn and field arrays."""
+
+        return {"timebin": self.times, "asn": self.asns[self.asn_numbers()],
+                self.field: self.values}
+
+    def resample(self, step, how="mean"):
+        """Aggregate values of each ASN in time bins of the given duration
+        (seconds, or e.g. "1h", "1d"), bins are aligned on the epoch (UTC
+        days). Bins without values are left out.
+
+        :how: Reduction of the values of a bin, see REDUCTIONS.
+        """
+
+        step = seconds(step)
+        times = self.times.astype(np.int64)
+        bins = times - times % step
+        numbers = self.asn_numbers()
+        change = (numbers[1:] != numbers[:-1]) | (bins[1:] != bins[:-1])
+        starts = np.flatnonzero(np.concatenate(([len(bins) > 0], change)))
+
+        offsets = np.searchsorted(numbers[starts], np.arange(len(self.asns) + 1))
+        return TimeSeries(self.asns, offsets, bins[starts].astype("datetime64[s]"),
+                          reduce(self.values, starts, how), self.field)
+
+    def rolling(self, window, how="mean"):
+        """Reduce each value with the window-1 previous values of the same
+        ASN. The window is a number of values, resample first to get a
+        regular time step. Values with fewer than window-1 previous values are
+        NaN.
+
+        :how: "mean", "sum", "min", "max" or "median".
+        """
+
+        values = self.values
+        result = np.full(len(values), np.nan)
+        if window < 1 or len(values) < window:
+            return TimeSeries(self.asns, self.offsets, self.times, result, self.field)
+
+        # Windows ending at each value, from the window-th one
+        if how in ("mean", "sum"):
+            cumulative = np.concatenate(([0.0], np.cumsum(values)))
+            reduced = cumulative[window:] - cumulative[:-window]
+            if how == "mean":
+                reduced /= window
+        elif how in ("min", "max", "median"):
+            function = {"min": np.min, "max": np.max, "median": np.median}[how]
+            windows = np.lib.stride_tricks.sliding_window_view(values, window)
+            reduced = np.concatenate([
+                function(windows[i:i + ROLLING_CHUNK], axis=1)
+                for i in range(0, len(windows), ROLLING_CHUNK)])
+        else:
+            raise ValueError("Unknown rolling reduction: {}".format(how))
+
+        # Windows must not cross two ASNs
+        position = np.arange(len(values)) - self.offsets[:-1][self.asn_numbers()]
+        full = position >= window - 1
+        result[full] = reduced[full[window - 1:]]
+        return TimeSeries(self.asns, self.offsets, self.times, result, self.field)
+
+    def groupby(self, by="asn", how="mean"):
+        """Reduce values of each ASN, or of each time over all ASNs.
+
+        :by: "asn" or "timebin".
+        :how: Reduction, see REDUCTIONS.
+
+        :returns: Table with an array of ASNs (or times) and an array of
+        reduced values.
+        """
+
+        if by == "asn":
+            starts = self.offsets[:-1]
+            return {"asn": self.asns, self.field: reduce(self.values, starts, how)}
+
+        if by == "timebin":
+            order = np.argsort(self.times, kind="stable")
+            times = self.times[order]
+            change = times[1:] != times[:-1]
+            starts = np.flatnonzero(np.concatenate(([len(times) > 0], change)))
+            return {"timebin": times[starts], self.field: reduce(self.values[order], starts, how)}
+
+        raise ValueError("Unknown group: {}".format(by))
+
+    def save(self, fname):
+        """Store the time series in a numpy .npz file."""
+
+        tmp = temporary(fname)
+        with open(tmp, "wb") as fp:
+            np.savez(fp, asns=self.asns, offsets=self.offsets, times=self.times,
+                     values=self.values, field=np.array(self.field))
+        os.replace(tmp, fname)
+
+    @classmethod
+    def load(cls, fname):
+        """Read a time series stored with save."""
+
+        with np.load(fname) as data:
+            return cls(data["asns"], data["offsets"], data["times"], data["values"],
+                       str(data["field"]))
+
+
+def cached(client, name, compute, kind=None):
+    """Return compute(), a TimeSeries computed from the results of the client,
+    computed only once for the same query and name.
+
+    Results are kept in the memory cache (see ihr.memory) and, if the
+    client uses the cache and the time window is over (see
+    ShardCache.settled), in the cache directory (see ShardCache.aggregate)
+    where they are pruned like shards.
+
+        hourly = cached(delay, "hourly-max",
+                        lambda: delay.get_series().resample("1h", "max"))
+
+    :client: Delay or Forwarding client.
+    :name: Name of the computation, e.g. "hourly-max".
+    :compute: Function returning a TimeSeries.
+    :kind: Class of the result if it's not a TimeSeries, with the same save,
+    load and nbytes methods (e.g. ihr.intervals.EventIndex).
+    """
+
+    kind = kind or TimeSeries
+
+    query = json.dumps([client.endpoint, sorted(map(str, client.keys())), client.af,
+                        arrow.get(client.start).isoformat(),
+                        arrow.get(client.end).isoformat(), name])
+    digest = hashlib.sha1(query.encode("utf-8")).hexdigest()
+    key = ("aggregate", digest)
+    series = memory.cache.get(key)
+    if series is not None:
+        return series
+
+    found = False
+    if client.cache:
+        # Aggregates are cache entries, evicted and expired like shards
+        fname, found = client.shards.aggregate(
+            "{}_{}".format(client.endpoint, digest), arrow.get(client.end).floor("day"))
+    if found:
+        series = kind.load(fname)
+    else:
+        series = compute()
+        if client.cache and client.shards.settled(arrow.get(client.end)):
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            series.save(fname)
+
+    memory.cache.put(key, series, series.nbytes)
+    return series
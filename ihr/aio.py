@@ -0,0 +1,170 @@
+import time
+import asyncio
+import logging
+from datetime import timedelta
+import ujson as json
+import arrow
+import aiohttp
+from ihr import memory
+from ihr.cache import SpooledPage
+from ihr.scheduler import PageScheduler, Concurrency, check
+
+
+class Response():
+    """API response, with the same attributes as the responses processed by
+    worker_task."""
+
+    def __init__(self, status_code, data, headers=None, elapsed=None, size=0):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.data = data
+        self.headers = headers or {}
+        self.elapsed = elapsed
+        self.size = size
+
+    def close(self):
+        pass
+
+
+async def fetch(session, url, params, metrics=None):
+    """Single asynchronous API query, returns a Response."""
+
+    # aiohttp accepts only strings and numbers
+    params = {name: value if isinstance(value, (int, float)) else str(value)
+              for name, value in params.items()}
+
+    sent = time.monotonic()
+    async with session.get(url, params=params) as resp:
+        body = await resp.read()
+        started = time.perf_counter()
+        try:
+            data = json.loads(body)
+        except ValueError:
+            logging.error("Error while reading Atlas json data.\n")
+            data = {}
+
+        if metrics is not None:
+            metrics.incr("response_bytes", len(body))
+            metrics.observe("decode_seconds", time.perf_counter() - started)
+
+        return Response(resp.status, data, resp.headers,
+                        timedelta(seconds=time.monotonic() - sent), len(body))
+
+
+async def memoize(request, key):
+    """Await the given fetch coroutine and keep the page in the memory
+    cache."""
+
+    resp = await request
+    if resp.ok and isinstance(resp.data.get("results"), list):
+        results = resp.data["results"]
+        memory.cache.put(key, dict(resp.data, results=memory.copy_results(results)),
+                         memory.sizeof(results))
+    return resp
+
+
+class AsyncPageScheduler(PageScheduler):
+    """PageScheduler running on the asyncio event loop. Query.submit should
+    return an asyncio task (or None for invalid queries)."""
+
+    errors = (aiohttp.ClientError, asyncio.TimeoutError)
+
+    async def __aiter__(self):
+        """Yield (query, page, response) tuples until all pages are
+        received."""
+
+        self.fill()
+        while self.in_flight or self.delayed or self.restored:
+            done = ()
+            if self.restored:
+                pass
+            elif self.in_flight:
+                done, _ = await asyncio.wait(
+                    list(self.in_flight), timeout=self.timeout(),
+                    return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(self.timeout())
+            for query, page, resp in self._collect(done):
+                self._returned(query)
+                yield query, page, resp
+
+
+async def aget_key_results(client, ordered=False, concurrency=4):
+    """Asynchronous generator of the client (key, results) tuples, see
+    Client.aget_key_results.
+
+    :concurrency: Concurrency instance or fixed number of concurrent
+    requests.
+    """
+
+    if not isinstance(concurrency, Concurrency):
+        concurrency = Concurrency(concurrency, concurrency, concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency.maximum)
+
+    loop = asyncio.get_running_loop()
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        def submit(key, start, end):
+            # Results of days that are over don't change
+            memoized = client.cache and client.shards.settled(arrow.get(end))
+
+            def request(page):
+                params = client.key_params(key, page=page, start=start, end=end)
+                if params is None:
+                    return None
+                client.params = params
+
+                name = memory.request_key(client.url, params)
+                if memoized:
+                    data = memory.cache.get(name)
+                    if data is not None:
+                        client.metrics.incr("memory_hits", kind="page")
+                        return memory.done_future(SpooledPage(
+                            dict(data, results=memory.copy_results(data["results"]))),
+                            loop)
+
+                def send():
+                    coro = fetch(session, client.url, params, client.metrics)
+                    if memoized:
+                        coro = memoize(coro, name)
+                    return asyncio.ensure_future(coro)
+
+                # Futures can't be shared between event loops
+                return memory.flights.submit((id(loop),) + name, send)
+            return request
+
+        segments, queries = client.segments(submit)
+        scheduler = AsyncPageScheduler(queries, concurrency, ordered, client.retries,
+                                       metrics=client.metrics,
+                                       max_buffered=client.max_buffered)
+        scheduler.fill()
+        pages = scheduler.__aiter__()
+        convert = client.converter()
+
+        try:
+            for keys, start, query in segments:
+                if query is None:
+                    for key in keys:
+                        for results in client.read_cache(key, start):
+                            yield key, convert(results) if convert else results
+
+                elif ordered:
+                    # Pages of this query (or of its time slices) are the next
+                    # ones in the scheduler
+                    while not query.complete:
+                        part, page, resp = await pages.__anext__()
+                        for key, results in client.process(part, page, resp):
+                            yield key, convert(results) if convert else results
+
+            async for query, page, resp in pages:
+                for key, results in client.process(query, page, resp):
+                    yield key, convert(results) if convert else results
+
+            check(queries)
+        finally:
+            for task in scheduler.in_flight:
+                task.cancel()
+            # Keep downloaded pages of interrupted queries
+            for query in queries:
+                if query.writer is not None and not query.complete:
+                    query.writer.close()
@@ -0,0 +1,306 @@
+import os
+import math
+import pickle
+import struct
+import tempfile
+import itertools
+import ujson as json
+import numpy as np
+from ihr.cache import timestamp, temporary
+
+MAGIC = b"IHRBIN1\n"
+# Size of the footer giving the position of the header
+FOOTER = struct.Struct("<Q")
+ALIGN = 8
+
+# Placeholder for missing values in dictionary-encoded fields
+MISSING = object()
+
+
+def _kind(types, missing, low=0, high=0):
+    """Return the storage kind of a field given the set of types of its
+    values, whether it is missing in some results and the range of its
+    integer values."""
+
+    if missing:
+        return "json"
+    if types == {int} and -2**63 <= low and high < 2**63:
+        return "int"
+    if types == {float}:
+        return "float"
+    if types == {bool}:
+        return "bool"
+    if types == {str}:
+        return "str"
+    return "json"
+
+
+def _encode(values, kind, index, table):
+    """Dictionary-encode the given values, return the list of codes. New
+    values are added to index (value to code) and table."""
+
+    codes = []
+    for value in values:
+        if value is MISSING:
+            codes.append(-1)
+            continue
+        if kind == "json":
+            value = json.dumps(value)
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(table)
+            table.append(value)
+        codes.append(code)
+
+    return codes
+
+
+def _code_dtype(size):
+    """Return the smallest integer type for codes of a table of the given
+    size."""
+
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        if size < np.iinfo(dtype).max:
+            return dtype
+
+
+def _batches(lines, batch_size):
+    """Yield lists of at most batch_size items of lines."""
+
+    lines = iter(lines)
+    while True:
+        batch = list(itertools.islice(lines, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class BinaryBackend():
+    """Compact columnar format for cache shards.
+
+    Each field is stored as a fixed-width array. Integers, floats and booleans
+    are stored as is, other values (e.g. timebin strings) are dictionary
+    encoded: an array of small integer codes plus a table of unique values.
+    Arrays are memory-mapped when reading so opening a shard is fast and
+    values are converted to Python objects only when needed.
+
+    File layout: magic, aligned arrays, JSON header, header position.
+    """
+
+    extension = "bin"
+    # Number of results decoded at once when writing
+    batch_size = 10000
+    # Size of the temporary file of results being written kept in memory
+    spool_size = 32 * 2**20
+
+    def write(self, fname, lines):
+        """Store the given results (iterable of JSON strings) in fname.
+
+        Results are decoded in batches and spooled field by field to a
+        temporary file (in memory until it reaches spool_size bytes), then
+        each field is written batch by batch. Memory usage then depends on the
+        batch size and on the number of distinct values of dictionary-encoded
+        fields, not on the number of results.
+        """
+
+        names = []
+        # Set of types, missing flag and range of the values of each field
+        stats = {}
+        # Number of results and spool position of each field of each batch
+        chunks = []
+
+        directory = os.path.dirname(fname) or "."
+        with tempfile.SpooledTemporaryFile(self.spool_size, dir=directory) as spool:
+            for batch in _batches(lines, self.batch_size):
+                results = [json.loads(line) for line in batch]
+                columns = {}
+                for i, res in enumerate(results):
+                    for name, value in res.items():
+                        column = columns.get(name)
+                        if column is None:
+                            column = columns[name] = ([], [])
+                            if name not in stats:
+                                names.append(name)
+                                stats[name] = [set(), bool(chunks), math.inf, -math.inf]
+                        column[0].append(i)
+                        column[1].append(value)
+
+                positions = {}
+                for name, (rows, values) in columns.items():
+                    field = stats[name]
+                    field[0].update(map(type, values))
+                    if len(rows) < len(results):
+                        field[1] = True
+                    else:
+                        rows = None
+                    if field[0] == {int}:
+                        field[2] = min(field[2], min(values))
+                        field[3] = max(field[3], max(values))
+                    positions[name] = spool.tell()
+                    pickle.dump((rows, values), spool, pickle.HIGHEST_PROTOCOL)
+                for name in names:
+                    if name not in columns:
+                        stats[name][1] = True
+                chunks.append((len(results), positions))
+
+            def field_values(name):
+                """Yield the values of the field in each batch, MISSING for
+                results without it."""
+
+                for size, positions in chunks:
+                    if name not in positions:
+                        yield [MISSING] * size
+                        continue
+                    spool.seek(positions[name])
+                    rows, values = pickle.load(spool)
+                    if rows is not None:
+                        column = [MISSING] * size
+                        for i, value in zip(rows, values):
+                            column[i] = value
+                        values = column
+                    yield values
+
+            header = {"rows": sum(size for size, _ in chunks), "fields": []}
+            tmp = temporary(fname)
+            with open(tmp, "wb") as fp:
+                fp.write(MAGIC)
+                for name in names:
+                    types, missing, low, high = stats[name]
+                    kind = _kind(types, missing, low, high)
+                    field = {"name": name, "kind": kind}
+
+                    if kind == "int":
+                        dtype = np.int64
+                        if np.iinfo(np.int32).min <= low and high <= np.iinfo(np.int32).max:
+                            dtype = np.int32
+                        arrays = (np.array(values, dtype=dtype)
+                                  for values in field_values(name))
+                    elif kind in ("float", "bool"):
+                        dtype = np.float64 if kind == "float" else np.bool_
+                        arrays = (np.array(values, dtype=dtype)
+                                  for values in field_values(name))
+                    else:
+                        # Codes are written once the table size is known
+                        index, table = {}, []
+                        for values in field_values(name):
+                            _encode(values, kind, index, table)
+                        field["table"] = table
+                        dtype = _code_dtype(len(table))
+                        arrays = (np.array(_encode(values, kind, index, table), dtype=dtype)
+                                  for values in field_values(name))
+
+                    fp.write(b"\0" * (-fp.tell() % ALIGN))
+                    field["offset"] = fp.tell()
+                    field["dtype"] = np.dtype(dtype).str
+                    for array in arrays:
+                        fp.write(array.tobytes())
+                    header["fields"].append(field)
+
+                position = fp.tell()
+                fp.write(json.dumps(header).encode("utf-8"))
+                fp.write(FOOTER.pack(position))
+
+        os.replace(tmp, fname)
+
+    @staticmethod
+    def open(fname):
+        """Return the header of the given file and a memory-mapped array for
+        each field."""
+
+        with open(fname, "rb") as fp:
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a binary cache file".format(fname))
+            fp.seek(-FOOTER.size, os.SEEK_END)
+            end = fp.tell()
+            position, = FOOTER.unpack(fp.read(FOOTER.size))
+            fp.seek(position)
+            header = json.loads(fp.read(end - position).decode("utf-8"))
+
+        arrays = {}
+        for field in header["fields"]:
+            if header["rows"] == 0:
+                arrays[field["name"]] = np.empty(0, dtype=field["dtype"])
+            else:
+                arrays[field["name"]] = np.memmap(
+                    fname, dtype=field["dtype"], mode="r",
+                    offset=field["offset"], shape=(header["rows"],))
+
+        return header, arrays
+
+    @staticmethod
+    def _table(field):
+        """Return the decoded table of a dictionary-encoded field, MISSING is
+        appended so that code -1 maps to it."""
+
+        table = field["table"]
+        if field["kind"] == "json":
+            table = [json.loads(value) for value in table]
+        return table + [MISSING]
+
+    def read_batches(self, fname, batch_size=1000):
+        """Yield results (dictionaries) stored in fname in lists of at most
+        batch_size results."""
+
+        header, arrays = self.open(fname)
+        names = [field["name"] for field in header["fields"]]
+        tables = {field["name"]: self._table(field)
+                  for field in header["fields"] if "table" in field}
+        # Missing values are only possible in dictionary-encoded fields
+        sparse = any((arrays[name] < 0).any() for name in tables)
+
+        for start in range(0, header["rows"], batch_size):
+            columns = []
+            for name in names:
+                values = arrays[name][start:start + batch_size].tolist()
+                if name in tables:
+                    table = tables[name]
+                    values = [table[code] for code in values]
+                columns.append(values)
+
+            if sparse:
+                yield [{name: value for name, value in zip(names, row)
+                        if value is not MISSING} for row in zip(*columns)]
+            else:
+                yield [dict(zip(names, row)) for row in zip(*columns)]
+
+    def read(self, fname):
+        """Return the list of results stored in fname."""
+
+        results = []
+        for batch in self.read_batches(fname, 100000):
+            results.extend(batch)
+        return results
+
+    def read_columns(self, fname, columns):
+        """Return a dictionary of numpy arrays for the given (field, dtype)
+        columns, see ihr.columns. Arrays are memory-mapped when the stored
+        type matches the requested one."""
+
+        header, arrays = self.open(fname)
+        fields = {field["name"]: field for field in header["fields"]}
+        if header["rows"] == 0:
+            return {name: np.empty(0, dtype=dtype) for name, dtype in columns}
+
+        table = {}
+        for name, dtype in columns:
+            field = fields.get(name)
+            if field is None:
+                raise KeyError(name)
+            if "table" not in field:
+                table[name] = arrays[name].astype(dtype, copy=False)
+                continue
+
+            values = self._table(field)[:-1]
+            if np.dtype(dtype).kind == "M":
+                lookup = np.array(
+                    [np.iinfo(np.int64).min if value is None else int(timestamp(value))
+                     for value in values] + [np.iinfo(np.int64).min],
+                    dtype=np.int64).astype("datetime64[s]").astype(dtype)
+            elif np.dtype(dtype).kind == "U":
+                lookup = np.array(values + [""], dtype=dtype)
+            else:
+                lookup = np.array(values + [0], dtype=dtype)
+            # Code -1 (missing values) maps to the last element
+            table[name] = lookup[arrays[name]]
+
+        return table
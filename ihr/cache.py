@@ -0,0 +1,753 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import threading
+import itertools
+import ujson as json
+from collections import namedtuple
+from functools import lru_cache
+import arrow
+from ihr.stream import iter_array
+
+
+@lru_cache(maxsize=65536)
+def timestamp(value):
+    """Return the UTC timestamp of the given date/time (string, datetime or
+    Arrow object). Results are memoized as the API repeats the same timebin
+    strings in many records."""
+    return arrow.get(value).float_timestamp
+
+
+@lru_cache(maxsize=65536)
+def day_of(value):
+    """Return the UTC day (YYYY-MM-DD) of the given date/time."""
+
+    return arrow.get(timestamp(value)).format("YYYY-MM-DD")
+
+
+def key_name(key):
+    """Return the name of a query key given as (field, value) pairs, e.g.
+    originasn2907_asnNone_af4. Tuples of values (see Client.groups) are comma
+    separated."""
+
+    return "_".join("{}{}".format(
+        field, ",".join(map(str, value)) if isinstance(value, tuple) else value)
+        for field, value in key)
+
+
+@lru_cache(maxsize=1024)
+def value_lookup(values):
+    """Return a dictionary mapping the values of a coalesced key field (see
+    Client.groups), and their string, to the values. Results then match keys
+    given as strings (e.g. asns=["2907"]) as well as the ints of the API,
+    see match_value."""
+
+    lookup = {str(value): value for value in values}
+    lookup.update((value, value) for value in values)
+    return lookup
+
+
+def match_value(values, value):
+    """Return the value of the tuple values matching the value of a result,
+    or None if there is none."""
+
+    lookup = value_lookup(values)
+    found = lookup.get(value)
+    if found is None:
+        found = lookup.get(str(value))
+    return found
+
+
+def temporary(fname):
+    """Return a temporary name for fname, unique to the process and thread so
+    that processes sharing the cache directory never write the same file."""
+
+    return "{}.{}-{}.tmp".format(fname, os.getpid(), threading.get_ident())
+
+
+class JSONBackend():
+    """Cache shards stored as JSON arrays."""
+
+    extension = "json"
+
+    def write(self, fname, lines):
+        """Store the given results (iterable of JSON strings) in fname."""
+
+        tmp = temporary(fname)
+        with open(tmp, "w") as fp:
+            fp.write("[")
+            for i, line in enumerate(lines):
+                if i:
+                    fp.write(",")
+                fp.write(line)
+            fp.write("]")
+
+        os.replace(tmp, fname)
+
+    def read(self, fname):
+        """Return the list of results stored in fname."""
+
+        with open(fname, "r") as fp:
+            return json.load(fp)
+
+    def read_batches(self, fname, batch_size=1000):
+        """Yield results stored in fname in lists of at most batch_size
+        results, without loading the whole file in memory."""
+
+        with open(fname, "r") as fp:
+            for batch in iter_array(fp, batch_size):
+                yield batch
+
+    def read_columns(self, fname, columns):
+        """Return results stored in fname as numpy arrays, see ihr.columns."""
+
+        from ihr.columns import to_columns
+
+        return to_columns(self.read(fname), columns)
+
+
+def get_backend(name):
+    """Return the shard backend for the given name ("json" or "binary")."""
+
+    if name == "json":
+        return JSONBackend()
+    if name == "binary":
+        from ihr.binary import BinaryBackend
+        return BinaryBackend()
+
+    raise ValueError("Unknown cache backend: {}".format(name))
+
+
+# Cache entry, the unit of eviction (see ShardCache.entries). Sizes are in
+# bytes, used and written are timestamps.
+Entry = namedtuple("Entry", ["endpoint", "key", "day", "size", "used", "written"])
+
+
+class CacheSize():
+    """Estimated size of a cache directory, shared by all the caches of the
+    process using that directory (see cache_size) so that it is computed
+    once, not by every client."""
+
+    def __init__(self):
+        # Estimated size in bytes, computed on the first store, and size left
+        # by the last prune
+        self.nbytes = None
+        self.pruned = 0
+        self.lock = threading.Lock()
+
+
+_sizes = {}
+_sizes_lock = threading.Lock()
+
+
+def cache_size(cache_dir):
+    """Return the CacheSize of the given cache directory."""
+
+    with _sizes_lock:
+        return _sizes.setdefault(os.path.abspath(cache_dir), CacheSize())
+
+
+class ShardCache():
+    """On-disk cache of API results stored in UTC day shards.
+
+    Each shard holds all the results of one endpoint for one query key (e.g.
+    origin AS, AS and address family) and one UTC day. Query keys are given as
+    (field, value) pairs. The cache layout is:
+    cache_dir/endpoint/originasn2907_asnNone_af4/YYYY-MM-DD.json
+
+    Queries with different but overlapping time windows reuse the shards that
+    are already on disk and only the missing days are fetched from the API.
+    Shards are stored in the format of the given backend (JSON or binary, the
+    file extension depends on the backend).
+
+    Results of recent days may still be updated by the API, so shards written
+    soon after the end of their day expire (see ttl). If max_size is given the
+    least recently used shards are removed when the cache grows larger.
+    """
+
+    # Shards written less than `recent` seconds after the end of their day
+    # expire `ttl` seconds after they are written, as (recent, ttl) rules.
+    # Other shards never expire.
+    ttl = ((6 * 3600, 3600), (2 * 86400, 6 * 3600))
+    # Entries used (or written) more recently are not evicted, queries may
+    # still read them
+    grace = 3600
+    # Checkpointed pages of interrupted queries are removed after a week
+    spool_age = 7 * 86400
+    # Results computed from shards (see ihr.aggregate.cached) are entries of
+    # this pseudo endpoint, stored as cache_dir/aggregates/name/YYYY-MM-DD.npz
+    # where YYYY-MM-DD is the last day of the results
+    aggregates = "aggregates"
+
+    def __init__(self, cache_dir="cache/", backend="json", ttl=None, max_size=None):
+        """
+        :cache_dir: Directory used for cached results.
+        :backend: Storage format of the shards, "json" or "binary" (see
+        ihr.binary), or a backend instance.
+        :ttl: Expiration rules of recent shards, see ShardCache.ttl.
+        :max_size: Maximum size of the cache in bytes, by default the cache
+        is never pruned.
+        """
+
+        self.cache_dir = cache_dir
+        if isinstance(backend, str):
+            backend = get_backend(backend)
+        self.backend = backend
+        if ttl is not None:
+            self.ttl = ttl
+        self.max_size = max_size
+        self.size = cache_size(cache_dir)
+
+    def path(self, endpoint, key, day):
+        """Return the file name of the shard for the given day."""
+
+        return os.path.join(self.cache_dir, endpoint, key_name(key), "{}.{}".format(
+            day.format("YYYY-MM-DD"), self.backend.extension))
+
+    def extension(self, endpoint):
+        """Return the file extension of the entries of the given endpoint."""
+
+        return "npz" if endpoint == self.aggregates else self.backend.extension
+
+    def aggregate(self, name, day):
+        """Return the file name of the aggregate with the given name (see
+        ihr.aggregate.cached) of results up to the given day, and True if it is
+        in the cache and not expired. Cached aggregates are marked as used,
+        see prune."""
+
+        fname = os.path.join(self.cache_dir, self.aggregates, name, "{}.npz".format(
+            day.format("YYYY-MM-DD")))
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            return fname, False
+        if self.expired(day, stat.st_mtime):
+            return fname, False
+        try:
+            os.utime(fname, ns=(time.time_ns(), stat.st_mtime_ns))
+        except OSError:
+            pass
+        return fname, True
+
+    def has(self, endpoint, key, day):
+        """Return True if the shard for the given day is in the cache and not
+        expired."""
+
+        try:
+            written = os.stat(self.path(endpoint, key, day)).st_mtime
+        except OSError:
+            return False
+        return not self.expired(day, written)
+
+    def expired(self, day, written):
+        """Return True if results of the given day written at the given time
+        (timestamp) are stale, see ttl."""
+
+        delay = written - day.ceil("day").float_timestamp
+        for recent, ttl in sorted(self.ttl):
+            if delay < recent:
+                return time.time() > written + ttl
+        return False
+
+    def settled(self, day):
+        """Return True if results of the given day don't change anymore, i.e.
+        they would never expire."""
+
+        delay = time.time() - day.ceil("day").float_timestamp
+        return delay >= max((recent for recent, _ in self.ttl), default=0)
+
+    def touch(self, endpoint, key, day):
+        """Mark the given shard as used, see prune."""
+
+        fname = self.path(endpoint, key, day)
+        try:
+            os.utime(fname, ns=(time.time_ns(), os.stat(fname).st_mtime_ns))
+        except OSError:
+            pass
+
+    def read(self, endpoint, key, day):
+        """Return the list of results stored in the given shard."""
+
+        return self.backend.read(self.path(endpoint, key, day))
+
+    def read_batches(self, endpoint, key, day, batch_size=1000):
+        """Yield results stored in the given shard in lists of at most
+        batch_size results, without loading the whole shard in memory."""
+
+        return self.backend.read_batches(self.path(endpoint, key, day), batch_size)
+
+    def read_columns(self, endpoint, key, day, columns):
+        """Return results stored in the given shard as numpy arrays, see
+        ihr.columns."""
+
+        return self.backend.read_columns(self.path(endpoint, key, day), columns)
+
+    def signature(self, endpoint, key, day):
+        """Return a (signature, size) tuple for the given shard. The signature
+        identifies the shard across caches and changes when the shard is
+        rewritten, size is the size of the shard in bytes."""
+
+        fname = os.path.abspath(self.path(endpoint, key, day))
+        stat = os.stat(fname)
+        return (fname, stat.st_mtime_ns), stat.st_size
+
+    def store(self, endpoint, key, day, lines, time_field):
+        """Store results (iterable of JSON strings) of the given day."""
+
+        fname = self.path(endpoint, key, day)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        if self.max_size is None:
+            self.backend.write(fname, lines)
+            return
+
+        size = self.size
+        with size.lock:
+            if size.nbytes is None:
+                size.nbytes = self.usage()
+            elif os.path.exists(fname):
+                size.nbytes -= os.path.getsize(fname)
+        self.backend.write(fname, lines)
+        with size.lock:
+            size.nbytes += os.path.getsize(fname)
+            # Leave some room to avoid pruning after each store
+            full = size.nbytes > max(self.max_size, size.pruned + 0.1 * self.max_size)
+        if full:
+            self.prune(max_size=int(0.9 * self.max_size))
+
+    def entries(self, endpoint=None):
+        """Yield the shards (see Entry) of the given endpoint, or of all
+        endpoints. Aggregates are entries of the aggregates endpoint, keyed by
+        their name."""
+
+        if not os.path.isdir(self.cache_dir):
+            return
+        endpoints = [endpoint] if endpoint is not None else sorted(
+            name for name in os.listdir(self.cache_dir)
+            if os.path.isdir(os.path.join(self.cache_dir, name)))
+        for endpoint in endpoints:
+            extension = "." + self.extension(endpoint)
+            root = os.path.join(self.cache_dir, endpoint)
+            if not os.path.isdir(root):
+                continue
+            for key in sorted(os.listdir(root)):
+                if not os.path.isdir(os.path.join(root, key)):
+                    continue
+                for fname in sorted(os.listdir(os.path.join(root, key))):
+                    if not fname.endswith(extension):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(root, key, fname))
+                    except OSError:
+                        continue
+                    yield Entry(endpoint, key, fname[:-len(extension)], stat.st_size,
+                                max(stat.st_atime, stat.st_mtime), stat.st_mtime)
+
+    def spools(self):
+        """Yield the directories of checkpointed pages (see ShardWriter)."""
+
+        for root, dirs, _ in os.walk(self.cache_dir):
+            if os.path.basename(root) == ".pages":
+                for name in dirs:
+                    yield os.path.join(root, name)
+                dirs[:] = []
+
+    def usage(self):
+        """Return the total size of shards and checkpointed pages in
+        bytes."""
+
+        nbytes = 0
+        for root, _, files in os.walk(self.cache_dir):
+            if root == self.cache_dir:
+                continue
+            for fname in files:
+                try:
+                    nbytes += os.path.getsize(os.path.join(root, fname))
+                except OSError:
+                    pass
+        return nbytes
+
+    def remove(self, entry):
+        """Remove the given entry from the cache."""
+
+        path = os.path.join(self.cache_dir, entry.endpoint, entry.key)
+        try:
+            os.remove(os.path.join(path, "{}.{}".format(
+                entry.day, self.extension(entry.endpoint))))
+            os.rmdir(path)
+        except OSError:
+            pass
+
+    def prune(self, max_size=None, older_than=None, stale=True, grace=None):
+        """Remove entries from the cache.
+
+        :max_size: Remove least recently used entries until the cache is
+        smaller than max_size bytes.
+        :older_than: Remove entries not used for older_than seconds.
+        :stale: Remove expired entries (see ttl).
+        :grace: Entries used in the last grace seconds are never removed,
+        default is ShardCache.grace.
+
+        :returns: Number of removed entries and of freed bytes.
+        """
+
+        if grace is None:
+            grace = self.grace
+        now = time.time()
+        removed = freed = 0
+
+        # Checkpointed pages of queries that were never resumed
+        for spool in list(self.spools()):
+            if now - os.path.getmtime(spool) > self.spool_age:
+                logging.info("removing checkpointed pages {}".format(spool))
+                shutil.rmtree(spool, ignore_errors=True)
+
+        entries = []
+        for entry in self.entries():
+            recent = now - entry.used < grace
+            if not recent and ((stale and self.expired(arrow.get(entry.day), entry.written))
+                               or (older_than is not None and now - entry.used > older_than)):
+                self.remove(entry)
+                removed += 1
+                freed += entry.size
+            else:
+                entries.append(entry)
+
+        nbytes = None
+        if max_size is not None:
+            nbytes = self.usage()
+            for entry in sorted(entries, key=lambda entry: entry.used):
+                if nbytes <= max_size:
+                    break
+                if now - entry.used < grace:
+                    continue
+                self.remove(entry)
+                removed += 1
+                freed += entry.size
+                nbytes -= entry.size
+
+        if removed:
+            logging.info("removed {} cache entries ({} bytes)".format(removed, freed))
+        with self.size.lock:
+            if nbytes is not None:
+                self.size.nbytes = self.size.pruned = nbytes
+            elif self.size.nbytes is not None:
+                self.size.nbytes -= freed
+        return removed, freed
+
+    @staticmethod
+    def complete(day):
+        """Return True if the given day is over, only complete days are
+        cached."""
+
+        return day.ceil("day") <= arrow.utcnow()
+
+    def storable(self, start, end):
+        """Return the days stored by a query from start to end: days that are
+        over and entirely in its time window."""
+
+        start = arrow.get(start)
+        end = arrow.get(end)
+        return [day for day in self.days(start, end)
+                if self.complete(day) and day >= start and day.ceil("day") <= end]
+
+    def writer(self, endpoint, key, start, end, time_field):
+        """Return a ShardWriter storing results for the days between start
+        and end (see storable)."""
+
+        return ShardWriter(self, endpoint, key, start, end, time_field)
+
+    @staticmethod
+    def days(start, end):
+        """Return the list of UTC days (Arrow objects) between start and end."""
+
+        return list(arrow.Arrow.range("day", arrow.get(start).floor("day"),
+                                      arrow.get(end).floor("day")))
+
+    def plan(self, endpoint, key, start, end, resolution=0):
+        """Split the time window in segments that are either found in the
+        cache or have to be fetched from the API.
+
+        :resolution: Time resolution of the results in seconds. A window
+        ending less than resolution seconds before the end of a day (e.g. at
+        23:59) reaches its last results, the day is fetched until its end so
+        that it is stored.
+
+        :returns: List of (cached, start, end) tuples in chronological order.
+        Cached segments are whole days. Consecutive missing days are merged
+        into a single segment so that they can be fetched with a single query,
+        missing segments are not extended beyond the time window: days that
+        are not over or only partly in the window are not stored (see
+        storable), fetching them entirely would be wasted.
+        """
+
+        start = arrow.get(start)
+        end = arrow.get(end)
+        segments = []
+        for day in self.days(start, end):
+            day_end = day.ceil("day")
+            seg_end = min(day_end, end)
+            if self.complete(day) and (day_end - seg_end).total_seconds() < resolution:
+                seg_end = day_end
+            if self.has(endpoint, key, day):
+                segments.append((True, day, day_end))
+            elif segments and not segments[-1][0]:
+                segments[-1] = (False, segments[-1][1], seg_end)
+            else:
+                segments.append((False, max(day, start), seg_end))
+
+        return segments
+
+
+class SpooledPage():
+    """Page restored from a ShardWriter checkpoint or from the memory cache,
+    with the same attributes as API responses (see worker_task)."""
+
+    status_code = 200
+    ok = True
+    headers = {}
+    from_cache = True
+
+    def __init__(self, data):
+        self.data = data
+
+    def close(self):
+        pass
+
+
+class ShardWriter():
+    """Write the results of a query to daily shards.
+
+    Pages are spooled to disk as they are received and written to the shards,
+    in page order, once all pages of the query are received. Results are never
+    all kept in memory. Days without results are stored as empty shards so
+    that they are not fetched again.
+
+    Each page is checkpointed once all its results are received, so an
+    interrupted query (crash, failed page, consumer exception) is resumed by
+    the next query for the same days: checkpointed pages are read from the
+    spool and only missing pages are fetched. Only queries for days that are
+    over are resumed, more recent results may change between queries.
+
+    A query split in time slices (see Query.split) shares its writer with its
+    slices, pages are identified by the time window of the slice.
+
+    Results of coalesced queries (see Client.groups) are split by query key,
+    each key of the group gets its own shards.
+    """
+
+    def __init__(self, cache, endpoint, key, start, end, time_field):
+        """
+        :cache: ShardCache instance.
+        :endpoint: Endpoint name.
+        :key: Query key, (field, value) pairs. Values are tuples for fields
+        coalesced in a multi-value query.
+        :start: First day of the query.
+        :end: Last day of the query.
+        :time_field: Field used to split results by day.
+        """
+
+        self.cache = cache
+        self.endpoint = endpoint
+        self.key = key
+        self.days = cache.days(start, end)
+        # Days written to the shards, see ShardCache.storable
+        self.stored = cache.storable(start, end)
+        self.time_field = time_field
+        name = key_name(key)
+        if len(name) > 100:
+            # Long groups of keys
+            name = "group_" + hashlib.sha1(name.encode("utf-8")).hexdigest()
+        self.spool_dir = os.path.join(
+            cache.cache_dir, endpoint, name, ".pages", "{}_{}".format(
+                self.days[0].format("YYYY-MM-DD"), self.days[-1].format("YYYY-MM-DD")))
+        # Open files of pages being received
+        self.pages = {}
+        # Names of checkpointed pages
+        self.done = set()
+
+        if os.path.isdir(self.spool_dir):
+            if cache.complete(self.days[-1]):
+                self.done = {fname[:-len(".ndjson")] for fname in os.listdir(self.spool_dir)
+                             if fname.endswith(".ndjson")}
+                if self.done:
+                    logging.info("resuming {} with {} downloaded pages".format(
+                        key_name(key), len(self.done)))
+            else:
+                self.discard()
+
+    @staticmethod
+    def page_name(query, page):
+        """Return the name of the given page of a query (or time slice)."""
+
+        return "{}-{}-{}".format(int(timestamp(query.start)),
+                                 int(timestamp(query.end)), page)
+
+    def fname(self, name, ext="ndjson"):
+        """Return the spool file name for the given page name."""
+
+        return os.path.join(self.spool_dir, "{}.{}".format(name, ext))
+
+    def load(self, query, page):
+        """Return the checkpointed page (see SpooledPage) or None if the page
+        has to be downloaded."""
+
+        name = self.page_name(query, page)
+        if name not in self.done:
+            return None
+
+        with open(self.fname(name, "json"), "r") as fp:
+            data = json.load(fp)
+        with open(self.fname(name), "r") as fp:
+            data["results"] = [json.loads(line) for line in fp]
+        return SpooledPage(data)
+
+    def add(self, query, page, results):
+        """Append results of the given page to the spool."""
+
+        name = self.page_name(query, page)
+        if name in self.done:
+            return
+
+        if name not in self.pages:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self.pages[name] = open(temporary(self.fname(name)), "w")
+
+        fp = self.pages[name]
+        for res in results:
+            fp.write(json.dumps(res))
+            fp.write("\n")
+
+    def checkpoint(self, query, page, fields):
+        """Mark the given page as complete.
+
+        :fields: Fields of the page other than results (e.g. count and next).
+        """
+
+        name = self.page_name(query, page)
+        if name in self.done:
+            return
+
+        self.add(query, page, [])
+        fp = self.pages.pop(name)
+        fp.close()
+        with open(self.fname(name, "json"), "w") as out:
+            json.dump(fields, out)
+        os.replace(fp.name, self.fname(name))
+        self.done.add(name)
+
+    def commit(self, query):
+        """Write spooled results of the given query (or of its time slices)
+        to the shards and remove the spool."""
+
+        self.close()
+        os.makedirs(self.spool_dir, exist_ok=True)
+        logging.info("caching results to disk")
+        shards = {}
+        for day in self.stored:
+            shards[day.format("YYYY-MM-DD")] = (day, open(os.path.join(
+                self.spool_dir, day.format("YYYY-MM-DD")), "w"))
+
+        # Split results by day
+        names = [self.page_name(leaf, page) for leaf in query.leaves()
+                 for page in range(1, leaf.nb_pages + 1)]
+        for name in names:
+            with open(self.fname(name), "r") as fp:
+                for line in fp:
+                    shard = shards.get(day_of(json.loads(line)[self.time_field]))
+                    if shard is not None:
+                        shard[1].write(line)
+
+        keys = self.keys()
+        for day, fp in shards.values():
+            fp.close()
+            with open(fp.name, "r") as lines:
+                if len(keys) == 1:
+                    self.cache.store(self.endpoint, self.key, day,
+                                     (line.rstrip("\n") for line in lines),
+                                     self.time_field)
+                    continue
+
+                # Split the day by key, days without results are stored too
+                split = {key: [] for key in keys}
+                unmatched = 0
+                for line in lines:
+                    res = json.loads(line)
+                    key = tuple((field, match_value(value, res.get(field)))
+                                if isinstance(value, tuple) else (field, value)
+                                for field, value in self.key)
+                    if key in split:
+                        split[key].append(line.rstrip("\n"))
+                    else:
+                        unmatched += 1
+
+                # Keys would be stored without their results
+                if unmatched:
+                    logging.error("{} results of {} match none of its keys, {} is not "
+                                  "cached".format(unmatched, key_name(self.key),
+                                                  day.format("YYYY-MM-DD")))
+                    continue
+                for key, results in split.items():
+                    self.cache.store(self.endpoint, key, day, results, self.time_field)
+
+        self.discard()
+
+    def keys(self):
+        """Return the list of query keys ((field, value) pairs) of the
+        writer."""
+
+        fields = [field for field, value in self.key]
+        values = [value if isinstance(value, tuple) else (value,)
+                  for field, value in self.key]
+        return [tuple(zip(fields, key)) for key in itertools.product(*values)]
+
+    def close(self):
+        """Remove results of incomplete pages, checkpointed pages are kept to
+        resume the query later."""
+
+        for fp in self.pages.values():
+            fp.close()
+            os.remove(fp.name)
+        self.pages = {}
+
+    def discard(self):
+        """Remove spooled results."""
+
+        for fp in self.pages.values():
+            fp.close()
+        self.pages = {}
+        self.done = set()
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+        # Remove the .pages directory, and the key directory of groups
+        for path in (os.path.dirname(self.spool_dir),
+                     os.path.dirname(os.path.dirname(self.spool_dir))):
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+
+
+def open_cache(cache_dir="cache/", backend="json", ttl=None, max_size=None):
+    """Return the cache for the given backend: "json" or "binary" daily shards
+    (see ShardCache) or "sqlite" (see ihr.sqlite_cache)."""
+
+    if backend == "sqlite":
+        from ihr.sqlite_cache import SQLiteCache
+        return SQLiteCache(cache_dir, ttl, max_size)
+
+    return ShardCache(cache_dir, backend, ttl, max_size)
+
+
+def in_window(results, start, end, time_field, end_field=None):
+    """Return results with a time_field value between start and end. If
+    end_field is given it is also required to be before end."""
+
+    start = timestamp(start)
+    end = timestamp(end)
+    if end_field is None:
+        end_field = time_field
+
+    return [res for res in results
+            if timestamp(res[time_field]) >= start
+            and res[end_field] is not None and timestamp(res[end_field]) <= end]
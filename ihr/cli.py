@@ -0,0 +1,204 @@
+import re
+import sys
+import time
+import logging
+import argparse
+
+UNITS = {"": 1, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+DURATIONS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+
+def parse_size(value):
+    """Return the number of bytes for the given size, e.g. 500M or 2G."""
+
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([kmgt]?)b?", value.strip().lower())
+    if match is None:
+        raise argparse.ArgumentTypeError("invalid size: {}".format(value))
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def parse_duration(value):
+    """Return the number of seconds for the given duration, e.g. 12h or
+    30d."""
+
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([smhdw]?)", value.strip().lower())
+    if match is None:
+        raise argparse.ArgumentTypeError("invalid duration: {}".format(value))
+    return float(match.group(1)) * DURATIONS[match.group(2) or "s"]
+
+
+def format_size(nbytes):
+    """Return a human readable size."""
+
+    for unit in ("B", "KB", "MB", "GB"):
+        if nbytes < 1024:
+            return "{:.1f} {}".format(nbytes, unit)
+        nbytes /= 1024
+    return "{:.1f} TB".format(nbytes)
+
+
+def cache_info(cache, args):
+    """Print a summary of the cache content."""
+
+    import arrow
+
+    now = time.time()
+    endpoints = {}
+    for entry in cache.entries(args.endpoint):
+        if args.list:
+            print("{}\t{}\t{}\t{}\t{}".format(
+                entry.endpoint, entry.key, entry.day, entry.size,
+                "stale" if cache.expired(arrow.get(entry.day), entry.written) else ""))
+        stats = endpoints.setdefault(entry.endpoint, [0, 0, None, None, now])
+        stats[0] += 1
+        stats[1] += entry.size
+        stats[2] = entry.day if stats[2] is None else min(stats[2], entry.day)
+        stats[3] = entry.day if stats[3] is None else max(stats[3], entry.day)
+        stats[4] = min(stats[4], entry.used)
+
+    for endpoint, (count, size, first, last, used) in sorted(endpoints.items()):
+        print("{}: {} entries, {}, days {} to {}, not used for {:.1f} days".format(
+            endpoint, count, format_size(size), first, last, (now - used) / 86400))
+    print("total: {}".format(format_size(cache.usage())))
+
+
+def cache_prune(cache, args):
+    """Remove stale, old or least recently used entries."""
+
+    removed, freed = cache.prune(max_size=args.max_size, older_than=args.older_than,
+                                 stale=not args.keep_stale, grace=args.grace)
+    print("removed {} entries, {} freed".format(removed, format_size(freed)))
+
+
+def export(args, parser):
+    """Export results of many query keys in parallel, see ihr.export."""
+
+    from ihr.export import Export, client_class, read_keys
+
+    arguments = client_class(args.endpoint).arguments
+    shard_by = args.shard_by or arguments[0]
+    keys = list(args.keys)
+    if args.key_file:
+        keys += read_keys(args.key_file)
+    filters = {}
+    for name in ("originasns", "asns", "streamnames"):
+        values = getattr(args, name)
+        if values is None:
+            continue
+        if name not in arguments:
+            parser.error("--{} is not a filter of {}".format(name, args.endpoint))
+        if name == shard_by:
+            keys += values
+        else:
+            filters[name] = values
+    if not keys:
+        parser.error("no {} to export, see --keys and --key-file".format(shard_by))
+
+    try:
+        job = Export(args.output, args.endpoint, keys, args.start, args.end, filters,
+                     shard_by, args.af, args.format, args.shard_keys, args.shard_days)
+    except ValueError as error:
+        parser.error(str(error))
+
+    options = dict(cache=not args.no_cache, cache_dir=args.cache_dir,
+                   cache_backend=args.cache_backend, max_threads=args.threads)
+    if args.url:
+        options["url"] = args.url
+
+    failed = 0
+    results = 0
+    try:
+        for name, count, error in job.run(args.workers, **options):
+            results += count
+            if error is not None:
+                failed += 1
+                print("{}: failed ({})".format(name, error))
+            else:
+                print("{}: {} results".format(name, count))
+    except ValueError as error:
+        print(error)
+        return 1
+
+    print("exported {} results, {} shards failed, {} shards remaining".format(
+        results, failed, len(job.pending())))
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    """Command line interface, see abondance --help."""
+
+    parser = argparse.ArgumentParser(
+        prog="abondance", description="Internet Health Report API client")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    cache = commands.add_parser("cache", help="inspect and prune the cache")
+    cache.add_argument("action", choices=("info", "prune"))
+    cache.add_argument("--cache-dir", default="cache/")
+    cache.add_argument("--cache-backend", default="json",
+                       choices=("json", "binary", "sqlite"))
+    cache.add_argument("--endpoint", help="only show results of this endpoint")
+    cache.add_argument("--list", action="store_true", help="list all entries")
+    cache.add_argument("--max-size", type=parse_size,
+                       help="remove least recently used entries above this size (e.g. 10G)")
+    cache.add_argument("--older-than", type=parse_duration,
+                       help="remove entries not used for this duration (e.g. 30d)")
+    cache.add_argument("--keep-stale", action="store_true",
+                       help="keep expired entries of recent days")
+    cache.add_argument("--grace", type=parse_duration,
+                       help="never remove entries used more recently (default 1h)")
+
+    export_parser = commands.add_parser(
+        "export", help="export results of many query keys in parallel",
+        description="Export results to a directory, split in shards fetched by "
+        "worker processes. Rerun the same command to resume an interrupted export.")
+    export_parser.add_argument("endpoint", choices=("hegemony", "delay", "forwarding", "disco"))
+    export_parser.add_argument("output", help="export directory")
+    export_parser.add_argument("--start", required=True, help="start date/time")
+    export_parser.add_argument("--end", required=True, help="end date/time")
+    export_parser.add_argument("--keys", nargs="+", default=[],
+                               help="ASNs (or stream names for disco) to export")
+    export_parser.add_argument("--key-file", "--asn-file",
+                               help="file with one ASN (or stream name) per line")
+    export_parser.add_argument("--shard-by", choices=("originasns", "asns", "streamnames"),
+                               help="argument of the keys, split between shards (default "
+                               "originasns for hegemony, asns or streamnames otherwise)")
+    export_parser.add_argument("--originasns", nargs="+", type=int)
+    export_parser.add_argument("--asns", nargs="+", type=int)
+    export_parser.add_argument("--streamnames", nargs="+")
+    export_parser.add_argument("--af", type=int, default=4)
+    export_parser.add_argument("--format", default="ndjson", choices=("ndjson", "binary"))
+    export_parser.add_argument("--workers", type=int, default=4, help="worker processes")
+    export_parser.add_argument("--threads", type=int, default=16,
+                               help="maximum concurrent requests per worker")
+    export_parser.add_argument("--shard-keys", type=int, default=100,
+                               help="keys per shard")
+    export_parser.add_argument("--shard-days", type=int, default=1, help="days per shard")
+    export_parser.add_argument("--cache-dir", default="cache/")
+    export_parser.add_argument("--cache-backend", default="json",
+                               choices=("json", "binary", "sqlite"))
+    export_parser.add_argument("--no-cache", action="store_true")
+    export_parser.add_argument("--url", help="API url of the endpoint")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(message)s",
+                        level=logging.INFO if args.verbose else logging.WARNING)
+
+    if args.command == "export":
+        return export(args, export_parser)
+
+    if args.command == "cache":
+        from ihr.cache import open_cache
+
+        cache = open_cache(args.cache_dir, args.cache_backend)
+        if args.action == "info":
+            cache_info(cache, args)
+        else:
+            cache_prune(cache, args)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
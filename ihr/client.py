@@ -0,0 +1,997 @@
+import copy
+import time
+import math
+import logging
+import itertools
+from functools import partial
+from ihr import memory
+from ihr import metrics as ihr_metrics
+
+# Heavy dependencies (arrow, requests, ujson and the modules using them) are
+# imported by the methods using them, on the first request, so that
+# importing and creating clients is fast (e.g. for short-lived scripts)
+
+
+def worker_task(resp, *args, metrics=None, decoder=None, columns=None, **kwargs):
+    """Process json in background. If a decoder is given (see ihr.decode) the
+    page is decoded in a worker process, and results are converted to numpy
+    arrays if columns is given."""
+    from ihr import transport
+
+    decoded = None
+    try:
+        body = transport.read_body(resp, metrics)
+        started = time.perf_counter()
+        if decoder is None:
+            resp.data = resp.json()
+        else:
+            resp.data = decoder.decode(body, columns)
+        decoded = time.perf_counter() - started
+    except ValueError:
+        logging.error("Error while reading Atlas json data.\n")
+        resp.data = {}
+
+    if metrics is not None:
+        metrics.incr("response_bytes", len(resp.content))
+        # Only decoding is timed, not reading and decompressing the body
+        if decoded is not None:
+            metrics.observe("decode_seconds", decoded)
+
+
+def stream_task(resp, *args, batch_size=1000, **kwargs):
+    """Read the first fields of the page (e.g. count and next) in background.
+    Results are decoded in batches when iterating over resp.data["results"]."""
+    from requests.exceptions import RequestException
+    from ihr.stream import PageStream, CHUNK_SIZE
+
+    try:
+        page = PageStream(resp.iter_content(CHUNK_SIZE), batch_size)
+        resp.data = dict(page.fields)
+        if page.has_results:
+            resp.data["results"] = page
+    except (ValueError, RequestException):
+        logging.error("Error while reading Atlas json data.\n")
+        resp.data = {}
+
+
+def memoize_task(key, future):
+    """Keep the page downloaded by the given future in the memory cache."""
+    from requests.exceptions import RequestException
+
+    try:
+        resp = future.result()
+    except RequestException:
+        return
+    if resp.ok and isinstance(resp.data.get("results"), list):
+        results = resp.data["results"]
+        memory.cache.put(key, dict(resp.data, results=memory.copy_results(results)),
+                         memory.sizeof(results))
+
+
+class Client():
+    """Common fetch and cache logic of the IHR API clients.
+
+    Endpoints are declared by subclasses with class attributes: the endpoint
+    name (used for the cache), the default API URL, the constructor arguments
+    giving the values of each query key field, and the time fields of the
+    results. Query keys (keys()) and API parameters (query_params()) are
+    derived from them, e.g.:
+
+        class Delay(Client):
+            endpoint = "delay"
+            url = "https://ihr.iijlab.net/ihr/api/link/delay/"
+            arguments = ("asns",)
+            key_fields = ("asn",)
+            required_fields = ("asn",)
+
+    Dependencies used to fetch results (arrow, requests) are imported, and
+    the HTTP session and cache are set up, on the first request, and the
+    cache directory is created when results are first stored.
+    """
+
+    endpoint = None
+    # Default API URL of the endpoint
+    url = None
+    # Constructor arguments giving the values of each key field, e.g.
+    # ("originasns", "asns"), they are the first arguments after start and end
+    arguments = ()
+    # Names of the fields of query keys, e.g. ("originasn", "asn")
+    key_fields = ()
+    # Queries must filter on at least one of these key fields
+    required_fields = ()
+    # Key fields accepting comma separated values in API queries, query keys
+    # are coalesced on these fields (see groups)
+    multi_fields = ()
+    # Maximum number of values per field in coalesced queries
+    max_group = 50
+    # Results are cached and queried by this field (e.g. timebin__gte)
+    time_field = "timebin"
+    # Results are also required to end before the end of the time window
+    end_field = None
+    # (field, numpy dtype) tuples used by get_columns
+    columns = ()
+    # Queries with more pages are split in time slices (see split)
+    max_pages = 10
+    # Minimum duration of time slices in seconds (time resolution of results)
+    min_slice = 900
+    # Maximum number of downloaded pages waiting for their turn in ordered
+    # mode, see PageScheduler
+    max_buffered = 64
+    # Use the process-wide HTTP connections and threads (see ihr.transport),
+    # otherwise each client opens its own, closed by close()
+    shared_transport = True
+
+    def __init__(self, start=None, end=None, af=4, session=None, cache=True,
+                 cache_dir="cache/", url=None, nb_threads=2, cache_backend="json",
+                 max_threads=16, retries=5, cache_size=None, cache_ttl=None,
+                 metrics=None, decode_workers=None, compact_records=False, **keys):
+        """
+        :start: Start date/time.
+        :end: End date/time.
+        :af: Adress family, default is IPv4
+        :session: Requests session to use, default is the HTTP transport
+        shared by all clients (see ihr.transport)
+        :cache: Set to False to ignore cache
+        :cache_dir: Directory used for cached results.
+        :url: API root url, default is the url of the endpoint
+        :nb_threads: Initial number of parallel downloads, adjusted to the API
+        load up to max_threads
+        :cache_backend: Format of cached results, "json", "binary" (compact
+        columnar format, requires numpy) or "sqlite" (single indexed database)
+        :max_threads: Maximum number of parallel downloads
+        :retries: Number of retries for failed requests
+        :cache_size: Maximum size of the cache in bytes, least recently used
+        results are removed from the cache when it grows larger
+        :cache_ttl: Expiration rules of recent results, see ShardCache.ttl
+        :metrics: Metrics instance reporting requests and cache usage, default
+        is ihr.metrics.registry
+        :decode_workers: Number of processes decoding API responses and
+        converting them to numpy arrays for get_columns when the cache is
+        disabled (see ihr.decode), other responses are decoded by the download
+        threads
+        :compact_records: Yield results as compact read-only records (see
+        ihr.records) instead of dictionaries, using much less memory
+        :keys: Values of the key arguments of the endpoint (see arguments),
+        e.g. originasns and asns for Hegemony. Each one is a single value or a
+        list of values, None (the default) doesn't filter results on this
+        field. Endpoint classes take them as explicit arguments after start
+        and end.
+
+        Notes: By default results are cached on disk in daily shards (based on
+        time_field), so queries with overlapping time windows fetch only the
+        missing days.
+        """
+
+        for argument in keys:
+            if argument not in self.arguments:
+                raise TypeError("{}() got an unexpected keyword argument '{}'".format(
+                    type(self).__name__, argument))
+        for argument in self.arguments:
+            value = keys.get(argument)
+            if value is None or isinstance(value, (int, str)):
+                value = [value]
+            setattr(self, argument, set(value))
+
+        self.start = start
+        self.end = end
+        self.af = af
+        self.cache = cache
+        self.nb_threads = nb_threads
+        self.max_threads = max(nb_threads, max_threads)
+        # HTTP session, adaptive concurrency and cache, see the properties
+        self.transport = None
+        self._session = session
+        self._concurrency = None
+        self._shards = None
+        self.retries = retries
+        # Number of results per API page, known once a full page is received
+        self.page_size = None
+        # Instrumentation of the fetch and cache paths, see ihr.metrics
+        self.metrics = (metrics or ihr_metrics.registry).bind(endpoint=self.endpoint)
+        # Decode pages in worker processes instead of the download threads
+        self.decoder = None
+        if decode_workers:
+            from ihr.decode import ProcessDecoder
+            self.decoder = ProcessDecoder(decode_workers)
+        # Yield slotted records instead of dictionaries, see ihr.records
+        self.compact_records = compact_records
+
+        self.url = url or self.url
+        self.cache_dir = cache_dir
+        self.cache_backend = cache_backend
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.params = {}
+
+    @property
+    def session(self):
+        """Requests session used for API requests, by default the session of
+        the process-wide transport (see shared_transport)."""
+
+        if self._session is None:
+            from ihr import transport
+            if self.shared_transport:
+                self._session = transport.shared(self.max_threads).session
+            else:
+                self.transport = transport.Transport(self.max_threads)
+                self._session = self.transport.session
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
+    @property
+    def concurrency(self):
+        """Number of requests in flight, shared by all queries of the client.
+        It starts at nb_threads and adapts to the API load (see
+        Concurrency)."""
+
+        if self._concurrency is None:
+            from ihr.scheduler import Concurrency
+            self._concurrency = Concurrency(self.nb_threads, self.max_threads)
+        return self._concurrency
+
+    @concurrency.setter
+    def concurrency(self, concurrency):
+        self._concurrency = concurrency
+
+    @property
+    def shards(self):
+        """Cache of the results, see open_cache."""
+
+        if self._shards is None:
+            from ihr.cache import open_cache
+            self._shards = open_cache(self.cache_dir, self.cache_backend, self.cache_ttl,
+                                      self.cache_size)
+        return self._shards
+
+    @shards.setter
+    def shards(self, shards):
+        self._shards = shards
+
+    def close(self):
+        """Close the HTTP connections of the client, unless they are shared
+        with other clients (see shared_transport) or the session was given."""
+
+        if self.transport is not None:
+            self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def keys(self):
+        """Return the list of query keys (tuples of query_params arguments),
+        all combinations of the values of the key arguments."""
+
+        return list(itertools.product(*(getattr(self, argument)
+                                         for argument in self.arguments)))
+
+    def cache_key(self, key):
+        """Return the query key as (field, value) pairs used by the cache."""
+
+        return tuple(zip(self.key_fields, key)) + (("af", self.af),)
+
+    def groups(self, keys):
+        """Coalesce query keys in groups fetched with a single query.
+
+        Keys are merged on the fields accepting multiple values (see
+        multi_fields), each group is the cartesian product of its values, so
+        that the API returns exactly the results of its keys. For example keys
+        (1, 174), (2, 174), (1, 3356), (2, 3356) are coalesced to
+        ((1, 2), (174, 3356)).
+
+        :returns: List of (group, keys) tuples, where group is a query key
+        with tuples of values for coalesced fields.
+        """
+
+        # Each field of a group is a tuple of values
+        groups = [tuple((value,) for value in key) for key in keys]
+        for i, field in enumerate(self.key_fields):
+            if field not in self.multi_fields:
+                continue
+
+            merged = {}
+            for group in groups:
+                # None (all values) can't be combined with other values
+                rest = group[:i] + group[i + 1:] + (group[i] == (None,),)
+                merged.setdefault(rest, []).extend(group[i])
+
+            groups = []
+            for rest, values in merged.items():
+                values = list(dict.fromkeys(values))
+                for j in range(0, len(values), self.max_group):
+                    groups.append(rest[:i] + (tuple(values[j:j + self.max_group]),)
+                                  + rest[i:-1])
+
+        return [(tuple(values if len(values) > 1 else values[0] for values in group),
+                 list(itertools.product(*group))) for group in groups]
+
+    def key_of(self, res, group):
+        """Return the query key of a result of the given group. Values are
+        compared as strings too, so that the key values given by the caller
+        are kept (e.g. asns=["2907"], the API returns ints)."""
+
+        from ihr.cache import match_value
+
+        key = []
+        for field, value in zip(self.key_fields, group):
+            if isinstance(value, tuple):
+                found = res.get(field)
+                match = match_value(value, found)
+                value = found if match is None else match
+            key.append(value)
+        return tuple(key)
+
+    def key_params(self, key, *args, **kwargs):
+        """Return the API parameters for the given query key or group (see
+        groups), page and time window."""
+
+        key = [",".join(map(str, value)) if isinstance(value, tuple) else value
+               for value in key]
+        return self.query_params(*key, *args, **kwargs)
+
+    def query_params(self, *args, page=None, start=None, end=None):
+        """Return the API parameters for a single query, or None if the query
+        is invalid.
+
+        :args: Values of the key fields, followed by the page number if page
+        is not given. None values don't filter results.
+        :start: Start of the time window, default is self.start.
+        :end: End of the time window, default is self.end.
+        """
+
+        import arrow
+
+        if page is None:
+            args, page = args[:-1], args[-1]
+        if start is None:
+            start = self.start
+        if end is None:
+            end = self.end
+
+        params = {
+            self.time_field + "__gte": arrow.get(start),
+            self.time_field + "__lte": arrow.get(end),
+            "af": self.af,
+            "page": page,
+            "format": "json",
+        }
+        for field, value in zip(self.key_fields, args):
+            if value is not None:
+                params[field] = value
+
+        if self.required_fields and not any(field in params for field in self.required_fields):
+            logging.error("You should give at least one of: {}.".format(
+                ", ".join(self.required_fields)))
+            return None
+        logging.info("query results for {}, page={}".format(args, page))
+        return params
+
+    def query_api(self, *args, batch_size=None, columns=False, **kwargs):
+        """Single API query. Don't call this method, use get_results instead."""
+
+        import arrow
+
+        params = self.key_params(args, **kwargs)
+        if params is None:
+            return None
+
+        # Results of days that are over don't change
+        end = kwargs.get("end") or self.end
+        memoize = self.cache and self.shards.settled(arrow.get(end))
+
+        # Results are converted to arrays by the decoding processes only if
+        # they are not cached or split by key (see process)
+        coalesced = any(isinstance(value, tuple) for value in args)
+        if columns and self.decoder is not None and not self.cache and not coalesced:
+            columns = self.columns
+        else:
+            columns = None
+        return self.get(params, batch_size, memoize, columns)
+
+    def get(self, params, batch_size=None, memoize=False, columns=None):
+        """Send an asynchronous request to the API, returns a future.
+
+        Identical requests in flight are merged into a single request. If
+        memoize is True downloaded pages are also kept in the memory cache
+        (see ihr.memory) and served from it.
+
+        If batch_size is given the response body is decoded incrementally
+        when iterating over resp.data["results"] (see stream_task). If
+        columns is given pages are converted to numpy arrays by the decoding
+        processes (see decode_workers)."""
+
+        from ihr.cache import SpooledPage
+
+        self.params = params
+        if batch_size is None:
+            key = memory.request_key(self.url, params)
+            if columns is not None:
+                key += (("columns", columns),)
+            if memoize:
+                data = memory.cache.get(key)
+                if data is not None:
+                    self.metrics.incr("memory_hits", kind="page")
+                    return memory.done_future(SpooledPage(
+                        dict(data, results=memory.copy_results(data["results"]))))
+
+            return memory.flights.submit(
+                key, partial(self._get, params, key if memoize else None, columns))
+
+        return self.session.get(
+            url=self.url, params=params, stream=True,
+            hooks={'response': partial(stream_task, batch_size=batch_size), }
+        )
+
+    def _get(self, params, key=None, columns=None):
+        """Send a request to the API, the page is kept in the memory cache if
+        key is given."""
+
+        future = self.session.get(
+            url=self.url, params=params,
+            # Dictionaries cost as much to send back from the decoding
+            # processes as to decode, only arrays are built in the processes
+            hooks={'response': partial(
+                worker_task, metrics=self.metrics,
+                decoder=self.decoder if columns is not None else None, columns=columns), }
+        )
+        if key is not None:
+            future.add_done_callback(partial(memoize_task, key))
+        return future
+
+    def plan(self, key):
+        """Return the (cached, start, end) segments for the given query key.
+        Without cache the whole time window is fetched from the API."""
+
+        import arrow
+
+        if not self.cache:
+            return [(False, arrow.get(self.start), arrow.get(self.end))]
+
+        segments = self.shards.plan(self.endpoint, self.cache_key(key),
+                                    self.start, self.end, self.min_slice)
+        for cached, start, end in segments:
+            self.metrics.incr("cache_hits" if cached else "cache_misses",
+                              len(self.shards.days(start, end)))
+        return segments
+
+    def filter(self, results, start, end):
+        """Trim results (list of dictionaries or numpy arrays, see
+        ihr.columns) of the given segment to the queried time window."""
+
+        import arrow
+        from ihr.cache import in_window
+
+        inside = start >= arrow.get(self.start) and end <= arrow.get(self.end)
+        if inside and self.end_field is None:
+            return results
+
+        if isinstance(results, dict):
+            from ihr.columns import in_window as in_window_columns
+            return in_window_columns(results, self.start, self.end,
+                                     self.time_field, self.end_field)
+
+        return in_window(results, self.start, self.end,
+                         self.time_field, self.end_field)
+
+    def read_cache(self, key, start, batch_size=None, columns=False):
+        """Yield cached results of the given query key and day. If batch_size
+        is given the cache file is decoded incrementally in lists of at most
+        batch_size results. If columns is True yield numpy arrays instead (see
+        ihr.columns), memory-mapped with the binary cache backend."""
+
+        logging.info("Get results from cache")
+        name = self.cache_key(key)
+        self.shards.touch(self.endpoint, name, start)
+        if columns:
+            batches = [self.read_shard(name, start, tuple(self.columns))]
+        elif batch_size is None:
+            batches = [self.read_shard(name, start)]
+        else:
+            _, size = self.shards.signature(self.endpoint, name, start)
+            self.metrics.incr("cache_read_bytes", size)
+            batches = self.shards.read_batches(self.endpoint, name, start, batch_size)
+
+        for results in batches:
+            results = self.filter(results, start, start.ceil("day"))
+            if len(results[self.time_field] if columns else results):
+                yield results
+
+    def read_shard(self, name, day, columns=None):
+        """Return results (or numpy arrays if columns is given) of the given
+        shard, recently read shards are kept in the memory cache. Results are
+        copies of the cached ones, arrays are read-only."""
+
+        signature, size = self.shards.signature(self.endpoint, name, day)
+        key = ("shard", signature, columns)
+        results = memory.cache.get(key)
+        if results is not None:
+            self.metrics.incr("memory_hits", kind="shard")
+            return memory.copy_results(results)
+
+        with self.metrics.timer("cache_read_seconds"):
+            if columns is None:
+                results = self.shards.read(self.endpoint, name, day)
+            else:
+                results = self.shards.read_columns(self.endpoint, name, day, columns)
+        self.metrics.incr("cache_read_bytes", size)
+        # Decoded results are much larger than compact (e.g. binary) shards
+        memory.cache.put(key, results, memory.sizeof(results))
+        return memory.copy_results(results)
+
+    def process(self, query, page, resp, columns=False):
+        """Yield (key, results) tuples for a downloaded page and cache the query
+        results once all its pages are received. If columns is True results
+        are converted to numpy arrays (see ihr.columns)."""
+
+        from requests.exceptions import RequestException
+        from ihr.scheduler import page_length
+
+        nb_results = 0
+        coalesced = any(isinstance(value, tuple) for value in query.key)
+        if resp is not None and resp.ok and "results" in resp.data:
+            batches = resp.data["results"]
+            # List of results, or arrays converted by the decoding processes
+            if isinstance(batches, (list, dict)):
+                batches = [batches]
+
+            try:
+                for results in batches:
+                    nb_results += page_length(results)
+                    if query.writer is not None:
+                        query.writer.add(query, page, results)
+                    results = self.filter(results, query.start, query.end)
+
+                    # Split results of coalesced queries by key
+                    if coalesced:
+                        split = {}
+                        for res in results:
+                            split.setdefault(self.key_of(res, query.key), []).append(res)
+                        split = split.items()
+                    else:
+                        split = [(query.key, results)]
+
+                    for key, results in split:
+                        if page_length(results):
+                            if columns and isinstance(results, list):
+                                from ihr.columns import to_columns
+                                results = to_columns(results, self.columns)
+                            yield key, results
+            except (ValueError, RequestException):
+                logging.error("Error while reading results for {}, page={}".format(
+                    query.key, page))
+                query.failed.append(page)
+            else:
+                if resp.data.get("next"):
+                    self.page_size = nb_results
+                if query.writer is not None:
+                    query.writer.checkpoint(query, page, {
+                        name: value for name, value in resp.data.items()
+                        if name != "results"})
+
+        if nb_results:
+            logging.info("got results for {}, page={}".format(query.key, page))
+        else:
+            logging.warning("No {} results for {}, page={}".format(
+                self.endpoint, query.key, page))
+
+        # Partial results are not cached, downloaded pages are kept to resume
+        # the query later
+        root = query.root
+        if root.complete and query.writer is not None:
+            leaves = list(root.leaves())
+            if any(leaf.invalid for leaf in leaves):
+                query.writer.discard()
+            elif any(leaf.failed for leaf in leaves):
+                query.writer.close()
+            else:
+                query.writer.commit(root)
+
+    def split(self, submit, query, count, page_size=None):
+        """Split a query with too many results in time slices, so that each
+        slice has at most max_pages pages (deep pages are slow to fetch) and
+        slices are fetched concurrently. Slices are split again if needed.
+
+        :submit: Function used to create the query, see segments.
+        :query: Query to split.
+        :count: Number of results of the query.
+        :page_size: Number of results per page, if known.
+
+        :returns: List of Query objects in time order, or None if the query is
+        shallow enough or too short to be split.
+        """
+
+        import arrow
+        from ihr.scheduler import Query
+
+        page_size = page_size or self.page_size
+        if not page_size:
+            return None
+
+        nb_pages = math.ceil(count / page_size)
+        if nb_pages <= self.max_pages:
+            return None
+
+        start = arrow.get(query.start)
+        # Time windows are inclusive, slices end just before the next one
+        end = arrow.get(query.end).shift(microseconds=1)
+        duration = (end - start).total_seconds()
+        nb_slices = min(math.ceil(nb_pages / self.max_pages),
+                        int(duration // self.min_slice))
+        if nb_slices < 2:
+            return None
+
+        bounds = [start.shift(seconds=int(i * duration / nb_slices))
+                  for i in range(nb_slices)] + [end]
+        parts = []
+        for slice_start, slice_end in zip(bounds, bounds[1:]):
+            slice_end = slice_end.shift(microseconds=-1)
+            part = Query(submit(query.key, slice_start, slice_end), query.key,
+                         slice_start, slice_end)
+            part.writer = query.writer
+            part.split = query.split
+            parts.append(part)
+
+        return parts
+
+    def segments(self, submit):
+        """Split the work in cached and missing segments.
+
+        Keys with the same cached and missing segments are coalesced in groups
+        fetched with a single query per missing segment (see groups).
+
+        :submit: Function taking a query key (or group) and time window, and
+        returning the function used to request a page (see Query).
+
+        :returns: List of (keys, start, query) tuples where query is None for
+        segments found in the cache, and the list of queries to fetch.
+        """
+
+        from ihr.scheduler import Query
+
+        keys = self.keys()
+        plans = {}
+        for key in keys:
+            plans.setdefault(tuple(self.plan(key)), []).append(key)
+
+        groups = []
+        for plan, plan_keys in plans.items():
+            if all(cached for cached, start, end in plan):
+                # Nothing to fetch, keys are read one after the other
+                groups.extend((key, [key], plan) for key in plan_keys)
+            else:
+                groups.extend((group, members, plan)
+                              for group, members in self.groups(plan_keys))
+
+        # Groups in the order of their first key
+        order = {key: i for i, key in enumerate(keys)}
+        groups.sort(key=lambda item: min(order[key] for key in item[1]))
+
+        segments = []
+        queries = []
+        for group, keys, plan in groups:
+            for cached, start, end in plan:
+                query = None
+                if not cached:
+                    query = Query(submit(group, start, end), group, start, end)
+                    query.split = partial(self.split, submit)
+                    # Only queries covering whole days that are over are
+                    # stored
+                    if self.cache and self.shards.storable(start, end):
+                        query.writer = self.shards.writer(
+                            self.endpoint, self.cache_key(group), start, end,
+                            self.time_field)
+                    queries.append(query)
+                segments.append((keys, start, query))
+
+        return segments, queries
+
+    def get_key_results(self, ordered=False, batch_size=None, columns=False):
+        """Same as get_results but yield (key, results) tuples, where key is
+        the query key (see keys()) of the results. If columns is True results
+        are numpy arrays (see iter_columns)."""
+
+        from ihr.scheduler import PageScheduler, check
+
+        segments, queries = self.segments(
+            lambda key, start, end: partial(self.query_api, *key, start=start, end=end,
+                                            batch_size=batch_size, columns=columns))
+        scheduler = PageScheduler(queries, self.concurrency, ordered, self.retries,
+                                  metrics=self.metrics, max_buffered=self.max_buffered,
+                                  page_size=lambda: self.page_size)
+        scheduler.fill()
+        pages = iter(scheduler)
+        convert = self.converter() if not columns else None
+
+        try:
+            for keys, start, query in segments:
+                if query is None:
+                    for key in keys:
+                        for results in self.read_cache(key, start, batch_size, columns):
+                            yield key, convert(results) if convert else results
+
+                elif ordered:
+                    # Pages of this query (or of its time slices) are the next
+                    # ones in the scheduler
+                    while not query.complete:
+                        part, page, resp = next(pages)
+                        for key, results in self.process(part, page, resp, columns):
+                            yield key, convert(results) if convert else results
+
+            for query, page, resp in pages:
+                for key, results in self.process(query, page, resp, columns):
+                    yield key, convert(results) if convert else results
+        finally:
+            # Keep downloaded pages of interrupted queries
+            for query in queries:
+                if query.writer is not None and not query.complete:
+                    query.writer.close()
+
+        check(queries)
+
+    def converter(self):
+        """Return a function converting lists of results to compact records
+        (see ihr.records), or None if compact_records is not set."""
+
+        if not self.compact_records:
+            return None
+
+        from ihr.records import RecordFactory
+
+        time_fields = (self.time_field,) + ((self.end_field,) if self.end_field else ())
+        return RecordFactory(type(self).__name__ + "Record", time_fields).convert
+
+    def get_results(self, ordered=False, batch_size=None):
+        """Fetch results for all query keys between the start and end dates.
+
+        Pages for all query keys are downloaded concurrently, see
+        PageScheduler. Failed requests are retried and the number of
+        concurrent requests adapts to the API load. Query keys are coalesced
+        in multi-value queries when possible (see groups).
+
+        :ordered: If True yield results in the order of the queries (groups
+        of query keys) and time, otherwise yield pages as soon as they are
+        downloaded.
+        :batch_size: If given, API responses and cache files are decoded
+        incrementally and results are yielded in lists of at most batch_size
+        results. Memory usage then does not depend on the size of pages and
+        cache files.
+
+        :returns: Generator of lists of results.
+        :raises FetchError: Once all results are returned, if some pages could
+        not be downloaded (see ihr.scheduler.FetchError).
+        """
+
+        for key, results in self.get_key_results(ordered, batch_size):
+            yield results
+
+    def iter_records(self, batch_size=None, ordered=False):
+        """Fetch results like get_results, but yield them one by one, or in
+        lists of exactly batch_size results (except the last one), whether
+        they come from the API or the cache.
+
+        API responses and cache files are decoded incrementally and results
+        are only downloaded as fast as they are consumed: at most
+        nb_threads/max_threads pages are in flight, and in ordered mode at
+        most max_buffered downloaded pages wait for their turn. Memory usage
+        then doesn't depend on the size of the results, even with a slow
+        consumer.
+
+        :batch_size: If given, yield lists of batch_size results instead of
+        single results.
+        :ordered: See get_results.
+
+        :returns: Generator of results (dictionaries, or records if
+        compact_records is set), or of lists of results.
+        """
+
+        # Pages are decoded in batches of the same size, or of the default
+        # size of stream_task for single results
+        records = (res for _, results in self.get_key_results(ordered, batch_size or 1000)
+                   for res in results)
+        if batch_size is None:
+            yield from records
+            return
+
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def follow(self, interval=900, ordered=False):
+        """Yield (key, results) tuples for the time window, then poll the API
+        every interval seconds and yield only new results. The generator
+        never ends.
+
+        The last time (time_field) seen for each query key is remembered and
+        polls only request newer results, so the load on the API is
+        proportional to the new data. self.end is moved to the time of the
+        last poll. Events that are not over yet (results without end_field,
+        or ending after the window) are requested again until they end.
+        Polled results are not cached.
+
+        :interval: Time between two polls in seconds.
+        :ordered: Order of the results of the time window, see
+        get_key_results.
+        """
+
+        import arrow
+        import ujson as json
+        from ihr.cache import timestamp
+
+        keys = self.keys()
+        # Next poll start per key, and results already yielded after it
+        starts = {}
+        recent = {key: [] for key in keys}
+
+        # With end_field, events of the last day may not be over yet
+        horizon = math.inf
+        if self.end_field is not None:
+            horizon = timestamp(arrow.get(self.end).floor("day"))
+
+        # Events ending after the window are trimmed here instead of by
+        # get_key_results, so that polls start before the earliest one
+        window = copy.copy(self)
+        window.end_field = None
+        window_end = timestamp(self.end)
+        last, pending = {}, {}
+        for key, results in window.get_key_results(ordered):
+            kept = []
+            for res in results:
+                when = timestamp(res[self.time_field])
+                if self.end_field is not None and (
+                        res[self.end_field] is None
+                        or timestamp(res[self.end_field]) > window_end):
+                    pending[key] = min(pending.get(key, when), when)
+                    continue
+                last[key] = max(last.get(key, when), when)
+                if when >= horizon:
+                    recent[key].append((when, res))
+                kept.append(res)
+            yield key, kept
+
+        for key in keys:
+            starts[key] = min(last.get(key, window_end) + 1, horizon,
+                              pending.get(key, math.inf))
+
+        next_poll = time.monotonic()
+        while True:
+            next_poll += interval
+            time.sleep(max(0, next_poll - time.monotonic()))
+            failed, ongoing = set(), {}
+            seen = {key: {json.dumps(res, sort_keys=True) for _, res in recent[key]}
+                    for key in keys if recent[key]}
+
+            for key, results in self.poll(starts, failed, ongoing):
+                if key in pending:
+                    # Before the last day only events trimmed from the window
+                    # are new, the others were yielded with it
+                    results = [res for res in results
+                               if timestamp(res[self.time_field]) >= horizon
+                               or timestamp(res[self.end_field]) > window_end]
+                if key in seen:
+                    results = [res for res in results
+                               if json.dumps(res, sort_keys=True) not in seen[key]]
+                for res in results:
+                    when = timestamp(res[self.time_field])
+                    last[key] = max(last.get(key, when), when)
+                    recent[key].append((when, res))
+                if results:
+                    yield key, results
+
+            # Keys without results start where the others end
+            end = max(last.values(), default=timestamp(self.end))
+            for key in keys:
+                if key not in failed:
+                    starts[key] = min(last.get(key, end) + 1, ongoing.get(key, math.inf))
+                recent[key] = [(when, res) for when, res in recent[key]
+                               if when >= starts[key]]
+
+            if failed:
+                logging.error("Failed to poll {} keys, retrying at the next poll".format(
+                    len(failed)))
+
+    def poll(self, starts, failed, ongoing):
+        """Fetch results of each query key from its start time (timestamp) to
+        now, see follow. Yield (key, results) tuples, keys of failed queries
+        are added to failed and the earliest start of events that are not
+        over yet are added to ongoing."""
+
+        import arrow
+        from ihr.cache import timestamp
+        from ihr.scheduler import Query, PageScheduler
+
+        self.end = arrow.utcnow()
+        submit = lambda key, start, end: partial(self.query_api, *key, start=start, end=end)
+        by_start = {}
+        for key, start in starts.items():
+            by_start.setdefault(start, []).append(key)
+
+        queries = []
+        members = {}
+        for start, keys in by_start.items():
+            start = arrow.get(start)
+            if start >= self.end:
+                continue
+            for group, group_keys in self.groups(keys):
+                query = Query(submit(group, start, self.end), group, start, self.end)
+                query.split = partial(self.split, submit)
+                queries.append(query)
+                members[query] = group_keys
+
+        scheduler = PageScheduler(queries, self.concurrency, False, self.retries,
+                                  metrics=self.metrics)
+        convert = self.converter()
+        for query, page, resp in scheduler:
+            if self.end_field is not None and resp is not None and resp.ok:
+                root = query.root
+                for res in resp.data.get("results", []):
+                    if res.get(self.end_field) is None:
+                        key = self.key_of(res, root.key) if len(members[root]) > 1 \
+                            else members[root][0]
+                        ongoing[key] = min(ongoing.get(key, math.inf),
+                                           timestamp(res[self.time_field]))
+
+            for key, results in self.process(query, page, resp):
+                yield key, convert(results) if convert else results
+
+        for query in queries:
+            if any(leaf.failed or leaf.invalid for leaf in query.leaves()):
+                failed.update(members[query])
+
+    def iter_columns(self, ordered=False, batch_size=None):
+        """Same as get_key_results but each list of results is converted to
+        a dictionary of numpy arrays, one per field in self.columns (requires
+        numpy). With the binary cache backend cached results are read directly
+        as arrays."""
+
+        return self.get_key_results(ordered, batch_size, columns=True)
+
+    def get_columns(self, batch_size=None):
+        """Fetch all results as numpy arrays (requires numpy).
+
+        Pages (or batches, see get_results) are converted to arrays as soon as
+        they are downloaded so that the dictionaries returned by the API are
+        not kept in memory.
+
+        :returns: Dictionary mapping each query key to a dictionary of numpy
+        arrays (one per field in self.columns) sorted by time.
+        """
+
+        from ihr.columns import concatenate
+
+        tables = {key: [] for key in self.keys()}
+        for key, table in self.iter_columns(True, batch_size):
+            tables[key].append(table)
+
+        return {key: concatenate(tables[key], self.columns) for key in tables}
+
+    def aget_key_results(self, ordered=False, concurrency=None):
+        """Asynchronous version of get_key_results, fetching all pages on the
+        running event loop (requires aiohttp).
+
+        :ordered: If True yield results in the order of the query keys and
+        time, otherwise yield pages as soon as they are downloaded.
+        :concurrency: Maximum number of concurrent requests, by default it
+        adapts to the API load (see Concurrency).
+
+        :returns: Asynchronous generator of (key, results) tuples.
+        """
+
+        from ihr.aio import aget_key_results
+
+        if concurrency is None:
+            concurrency = self.concurrency
+
+        return aget_key_results(self, ordered, concurrency)
+
+    async def aget_results(self, ordered=False, concurrency=None):
+        """Asynchronous version of get_results, see aget_key_results."""
+
+        async for key, results in self.aget_key_results(ordered, concurrency):
+            yield results
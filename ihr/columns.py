@@ -0,0 +1,65 @@
+import numpy as np
+from ihr.cache import timestamp
+
+# Value used for missing times (e.g. end of ongoing events)
+NAT = np.iinfo(np.int64).min
+
+
+def _times(results, field):
+    """Return an iterator of the timestamps (in seconds) of the given field."""
+
+    for res in results:
+        value = res[field]
+        yield NAT if value is None else int(timestamp(value))
+
+
+def to_columns(results, columns):
+    """Convert a list of results to a dictionary of numpy arrays.
+
+    :results: List of results (dictionaries) as returned by the API.
+    :columns: List of (field, dtype) tuples. Time fields should have a
+    datetime64 dtype, their values are parsed from the API strings. Text
+    fields should have the str dtype, arrays are as wide as the longest value.
+
+    :returns: Dictionary mapping each field to a numpy array.
+    """
+
+    table = {}
+    for field, dtype in columns:
+        if np.dtype(dtype).kind == "M":
+            values = np.fromiter(_times(results, field), dtype=np.int64,
+                                 count=len(results))
+            table[field] = values.astype("datetime64[s]").astype(dtype)
+        elif np.dtype(dtype).kind == "U":
+            table[field] = np.array([res[field] for res in results], dtype=dtype)
+        else:
+            table[field] = np.fromiter((res[field] for res in results),
+                                       dtype=dtype, count=len(results))
+
+    return table
+
+
+def concatenate(tables, columns):
+    """Concatenate tables created by to_columns. Return an empty table if
+    tables is empty."""
+
+    if not tables:
+        return {field: np.empty(0, dtype=dtype) for field, dtype in columns}
+
+    return {field: np.concatenate([table[field] for table in tables])
+            for field, _ in columns}
+
+
+def in_window(table, start, end, time_field, end_field=None):
+    """Return rows of the table with a time_field value between start and end.
+    If end_field is given it is also required to be before end."""
+
+    times = table[time_field]
+    start = np.datetime64(int(timestamp(start)), "s")
+    end = np.datetime64(int(timestamp(end)), "s")
+    if end_field is None:
+        end_field = time_field
+
+    # Comparisons with NaT are always False
+    mask = (times >= start) & (table[end_field] <= end)
+    return {field: values[mask] for field, values in table.items()}
@@ -0,0 +1,83 @@
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import ujson as json
+from ihr.memory import done_future
+
+# Process pools shared by all clients, by number of processes
+pools = {}
+pools_lock = threading.Lock()
+
+
+def decode_page(body, columns=None):
+    """Decode an API response body. If columns is given results are converted
+    to a dictionary of numpy arrays (see ihr.columns)."""
+
+    data = json.loads(body)
+    if columns is not None and isinstance(data.get("results"), list):
+        from ihr.columns import to_columns
+        data["results"] = to_columns(data["results"], columns)
+    return data
+
+
+class ProcessDecoder():
+    """Decode API responses in a pool of processes.
+
+    JSON decoding holds the GIL, so with many download threads decoding pages
+    in the threads doesn't scale. The threads send response bodies to worker
+    processes and wait for the decoded pages (see worker_task in
+    ihr.client). Results are also converted to numpy arrays in the workers
+    (see Client.get_columns): arrays are cheap to send back, while
+    unpickling dictionaries in the threads would cost about as much as
+    decoding the JSON, so pages of dictionaries are decoded in the threads.
+
+    Workers are started with the "spawn" method: like with multiprocessing,
+    the main module of scripts should be guarded with
+    if __name__ == "__main__".
+    """
+
+    # Smaller responses are decoded in the calling thread
+    min_size = 64 * 1024
+
+    def __init__(self, processes):
+        """
+        :processes: Number of worker processes.
+        """
+
+        self.processes = processes
+
+    @property
+    def pool(self):
+        with pools_lock:
+            pool = pools.get(self.processes)
+            if pool is None:
+                pool = pools[self.processes] = ProcessPoolExecutor(
+                    self.processes, mp_context=multiprocessing.get_context("spawn"))
+            return pool
+
+    def submit(self, body, columns=None):
+        """Decode the response body in a worker process, returns a future of
+        the decoded page (see decode_page)."""
+
+        if len(body) < self.min_size:
+            return done_future(decode_page(body, columns))
+
+        try:
+            return self.pool.submit(decode_page, body, columns)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed by the OOM killer), start a new pool
+            logging.warning("Decoding process pool is broken, restarting it")
+            with pools_lock:
+                pools.pop(self.processes, None)
+            return self.pool.submit(decode_page, body, columns)
+
+    def decode(self, body, columns=None):
+        """Return the decoded response body, see decode_page."""
+
+        try:
+            return self.submit(body, columns).result()
+        except BrokenProcessPool:
+            logging.warning("Decoding process died, decoding in the thread")
+            return decode_page(body, columns)
@@ -0,0 +1,219 @@
+import os
+import logging
+import importlib
+import multiprocessing
+import arrow
+import ujson as json
+from ihr.cache import temporary
+
+# Client class of each endpoint, the first key argument of the class (see
+# Client.arguments) is split between shards by default
+ENDPOINTS = {
+    "hegemony": ("ihr.hegemony", "Hegemony"),
+    "delay": ("ihr.link_delay", "Delay"),
+    "forwarding": ("ihr.link_forwarding", "Forwarding"),
+    "disco": ("ihr.disco_events", "Disconnect"),
+}
+# Key arguments taking names instead of ASNs
+NAME_ARGUMENTS = ("streamnames",)
+EXTENSIONS = {"ndjson": "ndjson", "binary": "bin"}
+
+
+def client_class(endpoint):
+    """Return the client class of the given endpoint."""
+
+    module, name = ENDPOINTS[endpoint]
+    return getattr(importlib.import_module(module), name)
+
+
+def read_keys(fname):
+    """Return the keys listed in the given file, one per line. Empty lines and
+    lines starting with # are ignored."""
+
+    with open(fname, "r") as fp:
+        return [line.strip() for line in fp
+                if line.strip() and not line.startswith("#")]
+
+
+def time_slices(start, end, days=1):
+    """Split the time window in slices of the given number of UTC days (the
+    first and last slices can be shorter). Slices are aligned on days so that
+    they never write the same cache shards."""
+
+    start = arrow.get(start)
+    end = arrow.get(end)
+    slices = []
+    while start <= end:
+        following = start.floor("day").shift(days=days)
+        slices.append((start, min(following.shift(microseconds=-1), end)))
+        start = following
+    return slices
+
+
+def export_shard(task):
+    """Fetch the results of a shard and write them to its output file, run by
+    the worker processes. The file is renamed once complete.
+
+    :returns: (shard name, number of results, error message or None) tuple.
+    """
+
+    output, spec, shard, options = task
+    kwargs = dict(spec["filters"], **options)
+    kwargs[spec["shard_by"]] = shard["keys"]
+    fname = os.path.join(output, "{}.{}".format(shard["name"], EXTENSIONS[spec["format"]]))
+    count = 0
+
+    def lines(client):
+        nonlocal count
+        for batch in client.iter_records(batch_size=1000):
+            count += len(batch)
+            for res in batch:
+                yield json.dumps(res)
+
+    try:
+        with client_class(spec["endpoint"])(shard["start"], shard["end"], af=spec["af"],
+                                            **kwargs) as client:
+            if spec["format"] == "binary":
+                from ihr.binary import BinaryBackend
+                BinaryBackend().write(fname, lines(client))
+            else:
+                tmp = temporary(fname)
+                with open(tmp, "w") as fp:
+                    for line in lines(client):
+                        fp.write(line)
+                        fp.write("\n")
+                os.replace(tmp, fname)
+    except Exception as error:
+        logging.exception("Failed to export {}".format(shard["name"]))
+        return shard["name"], count, "{}: {}".format(type(error).__name__, error)
+
+    return shard["name"], count, None
+
+
+def init_worker(level):
+    logging.basicConfig(format="%(asctime)s %(processName)s %(message)s", level=level)
+
+
+class Export():
+    """Export of the results of many query keys to a directory, fetched in
+    parallel by worker processes.
+
+    The work is split in shards of shard_keys query keys and shard_days days.
+    The export directory holds a manifest (export.json) describing the query
+    and its shards, and the output file of each finished shard (NDJSON, or
+    the binary columnar format of ihr.binary). Output files are written under
+    a temporary name and renamed once complete, so an interrupted export
+    resumes where it stopped: shards with an output file are not fetched
+    again. Workers share the cache directory.
+    """
+
+    manifest = "export.json"
+
+    def __init__(self, output, endpoint, keys, start, end, filters=None,
+                 shard_by=None, af=4, fmt="ndjson", shard_keys=100, shard_days=1):
+        """
+        :output: Export directory.
+        :endpoint: Endpoint name, "hegemony", "delay", "forwarding" or "disco".
+        :keys: Values of the shard_by argument, split between shards.
+        :start: Start date/time.
+        :end: End date/time.
+        :filters: Other arguments of the endpoint class (e.g. {"asns": [2497]}
+        for hegemony), the same for all shards.
+        :shard_by: Argument of the endpoint class split between shards,
+        default is originasns for hegemony, asns for delay and forwarding and
+        streamnames for disco.
+        :af: Address family.
+        :fmt: Output format, "ndjson" or "binary" (requires numpy).
+        :shard_keys: Number of query keys per shard.
+        :shard_days: Number of days per shard.
+        """
+
+        arguments = client_class(endpoint).arguments
+        shard_by = shard_by or arguments[0]
+        if shard_by not in arguments:
+            raise ValueError("{} results can't be split by {}".format(endpoint, shard_by))
+        if shard_by not in NAME_ARGUMENTS:
+            keys = [int(key) for key in keys]
+
+        self.output = output
+        self.spec = {
+            "endpoint": endpoint,
+            "shard_by": shard_by,
+            "filters": filters or {},
+            "start": arrow.get(start).isoformat(),
+            "end": arrow.get(end).isoformat(),
+            "af": af,
+            "format": fmt,
+            "shard_keys": shard_keys,
+            "shard_days": shard_days,
+        }
+
+        key_groups = [list(keys[i:i + shard_keys]) for i in range(0, len(keys), shard_keys)]
+        slices = time_slices(start, end, shard_days)
+        width = len(str(len(key_groups) * len(slices)))
+        self.shards = []
+        for group in key_groups:
+            for slice_start, slice_end in slices:
+                self.shards.append({
+                    "name": "part-{:0{}d}".format(len(self.shards), width),
+                    "keys": group,
+                    "start": slice_start.isoformat(),
+                    "end": slice_end.isoformat(),
+                })
+
+    def open(self):
+        """Create the export directory and manifest, or check that an
+        existing manifest describes the same export."""
+
+        os.makedirs(self.output, exist_ok=True)
+        fname = os.path.join(self.output, self.manifest)
+        if os.path.exists(fname):
+            with open(fname, "r") as fp:
+                manifest = json.load(fp)
+            if manifest["spec"] != self.spec or manifest["shards"] != self.shards:
+                raise ValueError("{} contains another export".format(self.output))
+            return
+
+        with open(fname + ".tmp", "w") as fp:
+            json.dump({"spec": self.spec, "shards": self.shards}, fp)
+        os.replace(fname + ".tmp", fname)
+
+    def done(self, shard):
+        """Return True if the output file of the shard is written."""
+
+        return os.path.exists(os.path.join(self.output, "{}.{}".format(
+            shard["name"], EXTENSIONS[self.spec["format"]])))
+
+    def pending(self):
+        """Return the list of shards that are not exported yet."""
+
+        return [shard for shard in self.shards if not self.done(shard)]
+
+    def run(self, workers=4, **options):
+        """Export all pending shards.
+
+        :workers: Number of worker processes.
+        :options: Other arguments of the endpoint class used by the workers,
+        e.g. cache_dir or max_threads.
+
+        :returns: Generator of (shard name, number of results, error message
+        or None) tuples, as shards are finished.
+        """
+
+        self.open()
+        pending = self.pending()
+        logging.info("{} shards to export, {} already done".format(
+            len(pending), len(self.shards) - len(pending)))
+        tasks = [(self.output, self.spec, shard, options) for shard in pending]
+
+        if workers <= 1:
+            for task in tasks:
+                yield export_shard(task)
+            return
+
+        # Workers are spawned, not forked, so they don't share connections
+        # or locks with the main process
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(workers, init_worker, (logging.getLogger().level,)) as pool:
+            for result in pool.imap_unordered(export_shard, tasks):
+                yield result
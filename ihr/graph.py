@@ -0,0 +1,196 @@
+import numpy as np
+from ihr.cache import timestamp
+from ihr.columns import to_columns, concatenate
+
+# Fields stored by HegemonyGraph, as in Hegemony.columns
+COLUMNS = (
+    ("timebin", "datetime64[s]"),
+    ("originasn", "int32"),
+    ("asn", "int32"),
+    ("hege", "float32"),
+)
+
+
+class HegemonyGraph():
+    """AS hegemony results indexed by origin AS and by transit AS.
+
+    Results are stored in numpy arrays (see COLUMNS) and sorted twice: by
+    origin AS, timebin and decreasing hegemony, and by (transit) AS, timebin
+    and decreasing hegemony. Dependencies of an origin AS, or dependents of an
+    AS, at a given timebin are then a contiguous range of the sorted arrays
+    found by binary search, already ordered for top-k and threshold queries.
+
+    The graph is built incrementally with add() (e.g. page by page from
+    get_results or iter_columns). Indexes are built by the first query after
+    results are added.
+
+        graph = Hegemony(originasns=[2907, 7922], start="2018-09-15",
+                         end="2018-09-16").get_graph()
+        graph.top(2907, "2018-09-15T12:00", k=10)
+        graph.dependents(2497, "2018-09-15T12:00", threshold=0.1)
+
+    Queries at a time that is not a timebin use the last timebin before it.
+    Results of a single address family are expected.
+    """
+
+    def __init__(self):
+        # Tables added since the indexes were built
+        self.chunks = []
+        self.table = None
+        # Sorted timebins, and index of the timebin of each result
+        self.timebins = None
+        # field -> (sorted keys, result numbers, sorted negated hegemony)
+        self.index = None
+
+    @classmethod
+    def from_results(cls, results):
+        """Build a graph from an iterable of lists of results (e.g.
+        get_results) or of tables of numpy arrays (e.g. iter_columns)."""
+
+        graph = cls()
+        for table in results:
+            graph.add(table)
+        return graph
+
+    @classmethod
+    def from_client(cls, client, batch_size=None):
+        """Build a graph from the results of the given Hegemony client. Cached
+        results are read as arrays, memory-mapped with the binary cache
+        backend, without creating dictionaries (see iter_columns)."""
+
+        return cls.from_results(table for _, table in client.iter_columns(batch_size=batch_size))
+
+    def add(self, results):
+        """Add results, a list of results (dictionaries) or a table of numpy
+        arrays with at least the fields of COLUMNS."""
+
+        if not isinstance(results, dict):
+            results = to_columns(results, COLUMNS)
+        if not len(results["timebin"]):
+            return
+        self.chunks.append({field: np.asarray(results[field], dtype=dtype)
+                            for field, dtype in COLUMNS})
+        self.index = None
+
+    def __len__(self):
+        return sum(len(table["timebin"]) for table in self.tables())
+
+    def tables(self):
+        if self.table is not None:
+            yield self.table
+        yield from self.chunks
+
+    def build(self):
+        """Sort results and build the indexes, called by queries if results
+        were added."""
+
+        if self.index is not None:
+            return
+
+        table = concatenate(list(self.tables()), COLUMNS)
+        self.chunks = []
+        self.timebins, times = np.unique(table["timebin"], return_inverse=True)
+        nb_times = max(len(self.timebins), 1)
+        dtype = np.int32 if len(table["hege"]) < 2**31 else np.int64
+
+        index = {}
+        for field in ("originasn", "asn"):
+            keys = table[field].astype(np.int64) * nb_times + times
+            order = np.lexsort((-table["hege"], keys)).astype(dtype)
+            index[field] = (keys[order], order, -table["hege"][order])
+
+        self.table = table
+        self.index = index
+
+    def timebin(self, when):
+        """Return the number of the last timebin at or before the given time,
+        raise KeyError if there is none."""
+
+        self.build()
+        when = np.datetime64(int(timestamp(when)), "s")
+        position = int(np.searchsorted(self.timebins, when, side="right")) - 1
+        if position < 0:
+            raise KeyError("No results before {}".format(when))
+        return position
+
+    def _range(self, field, value, when=None):
+        """Return the (start, end) positions of the results with the given
+        field value (and timebin) in the index of field."""
+
+        self.build()
+        keys = self.index[field][0]
+        nb_times = max(len(self.timebins), 1)
+        if when is None:
+            low = int(value) * nb_times
+            high = low + nb_times
+        else:
+            low = int(value) * nb_times + self.timebin(when)
+            high = low + 1
+        start, end = np.searchsorted(keys, [low, high])
+        return int(start), int(end)
+
+    def _select(self, field, other, value, when, threshold, k=None):
+        start, end = self._range(field, value, when)
+        _, order, neg_hege = self.index[field]
+        if threshold is not None:
+            if when is None:
+                rows = order[start:end][neg_hege[start:end] <= -threshold]
+            else:
+                end = start + int(np.searchsorted(neg_hege[start:end], -threshold,
+                                                  side="right"))
+                rows = order[start:end]
+        else:
+            rows = order[start:end]
+        if k is not None:
+            rows = rows[:k]
+
+        return {name: self.table[name][rows] for name in ("timebin", other, "hege")}
+
+    def dependencies(self, originasn, when=None, threshold=None):
+        """Return the dependencies of the given origin AS, at the given time or
+        at all timebins, optionally only those with a hegemony of at least
+        threshold. The origin AS itself is included (hegemony 1).
+
+        :returns: Dictionary of timebin, asn and hege arrays, sorted by
+        timebin and decreasing hegemony.
+        """
+
+        return self._select("originasn", "asn", originasn, when, threshold)
+
+    def dependents(self, asn, when=None, threshold=None):
+        """Return the origin ASes depending on the given AS, at the given time
+        or at all timebins, optionally only those with a hegemony of at least
+        threshold.
+
+        :returns: Dictionary of timebin, originasn and hege arrays, sorted by
+        timebin and decreasing hegemony.
+        """
+
+        return self._select("asn", "originasn", asn, when, threshold)
+
+    def top(self, originasn, when, k=10):
+        """Return the k main dependencies of the origin AS at the given time,
+        as a list of (asn, hege) tuples. The origin AS itself is excluded."""
+
+        table = self._select("originasn", "asn", originasn, when, None, k + 1)
+        return [(asn, hege) for asn, hege in zip(table["asn"].tolist(), table["hege"].tolist())
+                if asn != originasn][:k]
+
+    def top_dependents(self, asn, when, k=10):
+        """Return the k origin ASes depending the most on the given AS at the
+        given time, as a list of (originasn, hege) tuples. The AS itself is
+        excluded."""
+
+        table = self._select("asn", "originasn", asn, when, None, k + 1)
+        return [(origin, hege) for origin, hege
+                in zip(table["originasn"].tolist(), table["hege"].tolist())
+                if origin != asn][:k]
+
+    def hege(self, originasn, asn, when):
+        """Return the hegemony of asn for the origin AS at the given time, 0 if
+        asn is not a dependency."""
+
+        start, end = self._range("originasn", originasn, when)
+        rows = self.index["originasn"][1][start:end]
+        found = rows[self.table["asn"][rows] == asn]
+        return float(self.table["hege"][found[0]]) if len(found) else 0.0
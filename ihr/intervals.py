@@ -0,0 +1,215 @@
+import os
+import numpy as np
+from ihr.cache import timestamp, temporary
+from ihr.columns import NAT
+
+# End of events that are not over yet
+FOREVER = np.iinfo(np.int64).max
+
+
+def seconds(when):
+    return int(timestamp(when))
+
+
+class EventIndex():
+    """Disconnection events indexed by time, for overlap, containment and
+    point-in-time queries.
+
+    Events are stored in numpy arrays sorted by stream and start time, and
+    also ordered by start time over all streams. Along each order the running
+    maximum of end times is kept, both are sorted, so the events that may
+    overlap a time window are a range found by two binary searches: events
+    starting before the end of the window, after the last event ending
+    before the start of the window. Events of the range that ended earlier
+    (e.g. shorter than an older long event) are then filtered out. Queries
+    cost O(log n) plus the size of the range.
+
+    Events that are not over yet (no endtime) are active until the end of
+    time.
+
+        index = Disconnect(streamnames=["JP", "MX"], start="2018-01-01",
+                           end="2018-12-31").get_index()
+        index.active("2018-06-01T12:00")
+        index.overlapping("2018-06-01", "2018-06-02", streamname="JP")
+    """
+
+    def __init__(self, streams, table):
+        """
+        :streams: Sorted array of stream names.
+        :table: Dictionary of numpy arrays with at least starttime and
+        endtime (datetime64[s]) and stream (number of the stream in streams),
+        sorted by stream and starttime.
+        """
+
+        self.streams = streams
+        self.table = table
+
+        self.start = table["starttime"].astype(np.int64)
+        self.end = table["endtime"].astype(np.int64)
+        self.end[self.end == NAT] = FOREVER
+        self.offsets = np.searchsorted(table["stream"], np.arange(len(streams) + 1))
+        # Running maximum of end times of each stream
+        self.stream_max_end = np.empty_like(self.end)
+        for first, last in zip(self.offsets[:-1], self.offsets[1:]):
+            np.maximum.accumulate(self.end[first:last], out=self.stream_max_end[first:last])
+        self.positions = np.arange(len(self.start))
+
+        # All streams, by start time
+        self.order = np.argsort(self.start, kind="stable")
+        self.sorted_start = self.start[self.order]
+        self.max_end = np.maximum.accumulate(self.end[self.order]) if len(self.order) \
+            else self.end
+        self.sorted_end = np.sort(self.end)
+
+    @classmethod
+    def from_columns(cls, tables):
+        """Build the index from (key, table) tuples, as returned by iter_columns
+        of Disconnect, or from the dictionary returned by get_columns. Stream
+        names are taken from the streamname column of tables."""
+
+        if isinstance(tables, dict):
+            tables = tables.items()
+        parts = [table for _, table in tables if len(table["starttime"])]
+
+        if not parts:
+            return cls(np.empty(0, dtype=str),
+                       {"starttime": np.empty(0, dtype="datetime64[s]"),
+                        "endtime": np.empty(0, dtype="datetime64[s]"),
+                        "stream": np.empty(0, dtype=np.int32)})
+
+        fields = [field for field in parts[0] if all(field in part for part in parts)]
+        table = {field: np.concatenate([part[field] for part in parts]) for field in fields}
+        # Stream names are replaced by their number in the sorted streams
+        streams, codes = np.unique(table.pop("streamname"), return_inverse=True)
+        table["stream"] = codes.astype(np.int32)
+        order = np.lexsort((table["starttime"], table["stream"]))
+        return cls(streams, {field: values[order] for field, values in table.items()})
+
+    @classmethod
+    def from_client(cls, client, batch_size=None):
+        """Build the index from the results of a Disconnect client, converted
+        to arrays page by page (see iter_columns)."""
+
+        return cls.from_columns(client.iter_columns(batch_size=batch_size))
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self.table.values())
+
+    def _view(self, streamname):
+        """Return the start times, running maximum of end times and positions
+        of the events of the given stream (or all streams), by start time."""
+
+        if streamname is None:
+            return self.sorted_start, self.max_end, self.order
+
+        number = int(np.searchsorted(self.streams, streamname))
+        if number == len(self.streams) or self.streams[number] != streamname:
+            empty = self.positions[:0]
+            return empty, empty, empty
+        first, last = self.offsets[number], self.offsets[number + 1]
+        return (self.start[first:last], self.stream_max_end[first:last],
+                self.positions[first:last])
+
+    def select(self, positions):
+        """Return the events at the given positions as a table of arrays,
+        with stream names in streamname."""
+
+        events = {field: values[positions] for field, values in self.table.items()
+                  if field != "stream"}
+        events["streamname"] = self.streams[self.table["stream"][positions]]
+        return events
+
+    def _overlapping(self, start, end, streamname=None):
+        starts, max_ends, positions = self._view(streamname)
+        first = np.searchsorted(max_ends, start, side="left")
+        last = np.searchsorted(starts, end, side="right")
+        candidates = positions[first:last]
+        return candidates[self.end[candidates] >= start]
+
+    def overlapping(self, start, end, streamname=None):
+        """Return events active at some point between start and end, of the
+        given stream or of all streams, sorted by start time."""
+
+        return self.select(self._overlapping(seconds(start), seconds(end), streamname))
+
+    def active(self, when, streamname=None):
+        """Return events active at the given time, sorted by start time."""
+
+        when = seconds(when)
+        return self.select(self._overlapping(when, when, streamname))
+
+    def containing(self, start, end, streamname=None):
+        """Return events lasting at least from start to end."""
+
+        start, end = seconds(start), seconds(end)
+        if start > end:
+            return self.select(self.positions[:0])
+        # Events starting before start and ending after end
+        return self.select(self._overlapping(end, start, streamname))
+
+    def within(self, start, end, streamname=None):
+        """Return events that start and end between start and end."""
+
+        start, end = seconds(start), seconds(end)
+        starts, _, positions = self._view(streamname)
+        first = np.searchsorted(starts, start, side="left")
+        last = np.searchsorted(starts, end, side="right")
+        candidates = positions[first:last]
+        return self.select(candidates[self.end[candidates] <= end])
+
+    def count_active(self, when):
+        """Return the number of events (of all streams) active at the given
+        time, in O(log n)."""
+
+        when = seconds(when)
+        return int(np.searchsorted(self.sorted_start, when, side="right")
+                   - np.searchsorted(self.sorted_end, when, side="left"))
+
+    def merge(self, gap=0):
+        """Merge overlapping events of each stream, and events separated by at
+        most gap seconds.
+
+        :returns: EventIndex of the merged events, with starttime, endtime,
+        stream and the number of merged events in events.
+        """
+
+        if not len(self.start):
+            return EventIndex(self.streams, dict(self.table, events=np.empty(0, dtype=np.int64)))
+
+        stream = self.table["stream"]
+        previous_end = np.concatenate(([self.stream_max_end[0]], self.stream_max_end[:-1]))
+        new = np.concatenate(([True], (stream[1:] != stream[:-1])
+                              | (self.start[1:] - gap > previous_end[1:])))
+        starts = np.flatnonzero(new)
+
+        end = np.maximum.reduceat(self.end, starts)
+        endtime = end.astype("datetime64[s]")
+        endtime[end == FOREVER] = np.datetime64("NaT")
+        return EventIndex(self.streams, {
+            "starttime": self.table["starttime"][starts],
+            "endtime": endtime,
+            "stream": stream[starts],
+            "events": np.diff(np.append(starts, len(self.start))),
+        })
+
+    def save(self, fname):
+        """Store the index in a numpy .npz file."""
+
+        tmp = temporary(fname)
+        with open(tmp, "wb") as fp:
+            np.savez(fp, streams=self.streams,
+                     **{"table_" + field: values for field, values in self.table.items()})
+        os.replace(tmp, fname)
+
+    @classmethod
+    def load(cls, fname):
+        """Read an index stored with save."""
+
+        with np.load(fname) as data:
+            table = {name[len("table_"):]: data[name] for name in data.files
+                     if name.startswith("table_")}
+            return cls(data["streams"], table)
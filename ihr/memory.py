@@ -0,0 +1,189 @@
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class MemoryCache():
+    """Size-bounded LRU cache of results kept in memory.
+
+    Sizes are given by the caller, usually an estimate of the memory used by
+    the decoded results (see sizeof). Least recently used entries are evicted
+    once the total size exceeds max_bytes. The cache is shared by all threads.
+
+    Values are shared by all callers, results should be copied when they are
+    stored and returned (see copy_results) so that callers modifying their
+    results don't modify the cached ones.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        """
+        :max_bytes: Maximum total size of cached entries, 0 disables the
+        cache.
+        """
+
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return the value stored for the given key, or None."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        """Store a value of the given size (in bytes)."""
+
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            self._evict()
+
+    def resize(self, max_bytes):
+        """Change the maximum size of the cache, 0 disables the cache."""
+
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """Remove all entries."""
+
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.nbytes -= size
+
+
+class SingleFlight():
+    """Merge identical requests in flight: a request submitted while the same
+    request is being downloaded gets a future completed with the response of
+    the first one. Responses are shared and should not be modified."""
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key, request):
+        """Return the future of the in-flight request with the given key, or
+        call request() and return its future (or None)."""
+
+        with self.lock:
+            future = self.flights.get(key)
+            if future is not None and not future.done():
+                return follow(future)
+
+            future = request()
+            if future is None:
+                return None
+            self.flights[key] = future
+
+        future.add_done_callback(lambda done: self._done(key, done))
+        return future
+
+    def _done(self, key, future):
+        with self.lock:
+            if self.flights.get(key) is future:
+                del self.flights[key]
+
+
+def copy_results(results):
+    """Return a copy of results (list of dictionaries, or dictionary of numpy
+    arrays) that can be modified without modifying the given ones.
+
+    Dictionaries are copied but not their values, values of API results are
+    immutable (numbers, strings). Arrays are not copied but made read-only,
+    modifying them in place raises an error.
+    """
+
+    if isinstance(results, dict):
+        for values in results.values():
+            values.flags.writeable = False
+        return dict(results)
+
+    return [dict(res) if isinstance(res, dict) else res for res in results]
+
+
+def sizeof(results, samples=8):
+    """Return an estimate of the memory used by decoded results, a list of
+    results (dictionaries) or a dictionary of numpy arrays. The size of list
+    items is extrapolated from a few of them, values shared by several
+    results (e.g. interned strings) are counted for each of them.
+
+    :samples: Number of results measured.
+    """
+
+    if isinstance(results, dict):
+        return sum(values.nbytes for values in results.values())
+
+    size = sys.getsizeof(results)
+    if not results:
+        return size
+    step = max(1, len(results) // samples)
+    sampled = results[::step]
+    sampled_size = 0
+    for res in sampled:
+        sampled_size += sys.getsizeof(res)
+        if isinstance(res, dict):
+            sampled_size += sum(sys.getsizeof(value) for value in res.values())
+    return size + sampled_size * len(results) // len(sampled)
+
+
+def request_key(url, params):
+    """Return a normalized (hashable) key for the given API request."""
+
+    return (url,) + tuple(sorted((name, str(value)) for name, value in params.items()))
+
+
+def follow(future):
+    """Return a new future completed with the outcome of the given one."""
+
+    if isinstance(future, Future):
+        follower = Future()
+    else:
+        follower = future.get_loop().create_future()
+
+    def copy(done):
+        if follower.done():
+            return
+        if done.cancelled():
+            follower.cancel()
+        elif done.exception() is not None:
+            follower.set_exception(done.exception())
+        else:
+            follower.set_result(done.result())
+
+    future.add_done_callback(copy)
+    return follower
+
+
+def done_future(result, loop=None):
+    """Return a completed future (asyncio future if loop is given)."""
+
+    future = Future() if loop is None else loop.create_future()
+    future.set_result(result)
+    return future
+
+
+# Shared by all clients of the process
+cache = MemoryCache()
+flights = SingleFlight()
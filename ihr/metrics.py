@@ -0,0 +1,252 @@
+import time
+import socket
+import logging
+import threading
+from bisect import bisect_left
+
+# Upper bounds of histogram buckets, for timings (seconds) and other values
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def metric_key(name, labels):
+    """Return the (name, labels) key of a value, label values are strings."""
+
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+class Metrics():
+    """Counters and histograms of the fetch and cache paths.
+
+    Clients report (see Client.metrics):
+    - requests (counter, by status) and request_seconds: API requests and
+      their latency,
+    - response_bytes and decode_seconds: size of API responses and time spent
+      decoding them,
+    - response_wire_bytes and decompress_seconds (by encoding): size of
+      compressed responses and time spent decompressing them,
+    - queue_seconds: time pages wait for a free request slot,
+    - retries (by status) and failed_pages counters,
+    - query_pages: number of pages per query,
+    - cache_hits and cache_misses: days found or not in the disk cache,
+    - cache_read_bytes and cache_read_seconds: disk cache reads,
+    - memory_hits: pages and shards found in the memory cache.
+    Values have labels, e.g. endpoint="hegemony".
+
+    Hooks are called with (kind, name, value, labels) for each reported value,
+    kind is "counter" or "histogram", see StatsdExporter.
+    """
+
+    def __init__(self):
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> [bucket counts, sum, count]
+        self.histograms = {}
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def buckets(name):
+        """Return the histogram buckets for the given metric name."""
+
+        return TIME_BUCKETS if name.endswith("_seconds") else COUNT_BUCKETS
+
+    def incr(self, name, value=1, **labels):
+        """Add value to a counter."""
+
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        for hook in self.hooks:
+            hook("counter", name, value, labels)
+
+    def observe(self, name, value, **labels):
+        """Add a value (e.g. a duration in seconds) to a histogram."""
+
+        key = metric_key(name, labels)
+        buckets = self.buckets(name)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(buckets) + 1), 0, 0]
+            histogram[0][bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+        for hook in self.hooks:
+            hook("histogram", name, value, labels)
+
+    def timer(self, name, **labels):
+        """Return a context manager measuring the duration of its block in the
+        given histogram."""
+
+        return Timer(self, name, labels)
+
+    def bind(self, **labels):
+        """Return a view of the metrics adding the given labels to reported
+        values."""
+
+        return Bound(self, labels)
+
+    def counter(self, name, **labels):
+        """Return the value of a counter, summed over the labels that are not
+        given."""
+
+        _, labels = metric_key(name, labels)
+        with self.lock:
+            return sum(value for (key, key_labels), value in self.counters.items()
+                       if key == name and set(labels) <= set(key_labels))
+
+    def histogram(self, name, **labels):
+        """Return the (count, sum) of a histogram, summed over the labels that
+        are not given."""
+
+        _, labels = metric_key(name, labels)
+        count = total = 0
+        with self.lock:
+            for (key, key_labels), (_, value, nb) in self.histograms.items():
+                if key == name and set(labels) <= set(key_labels):
+                    count += nb
+                    total += value
+        return count, total
+
+    def reset(self):
+        """Remove all values."""
+
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def prometheus(self, prefix="ihr"):
+        """Return the metrics in the Prometheus text exposition format."""
+
+        def labels_text(labels, **extra):
+            labels = list(labels) + list(extra.items())
+            if not labels:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                                  for name, value in labels) + "}"
+
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(buckets), total, count))
+                                for key, (buckets, total, count) in self.histograms.items())
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append("# TYPE {}_{}_total counter".format(prefix, name))
+                typed.add(name)
+            lines.append("{}_{}_total{} {}".format(prefix, name, labels_text(labels), value))
+
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in typed:
+                lines.append("# TYPE {}_{} histogram".format(prefix, name))
+                typed.add(name)
+            cumulative = 0
+            for bound, nb in zip(self.buckets(name) + ("+Inf",), buckets):
+                cumulative += nb
+                lines.append("{}_{}_bucket{} {}".format(
+                    prefix, name, labels_text(labels, le=bound), cumulative))
+            lines.append("{}_{}_sum{} {}".format(prefix, name, labels_text(labels), total))
+            lines.append("{}_{}_count{} {}".format(prefix, name, labels_text(labels), count))
+
+        return "\n".join(lines) + "\n"
+
+
+class Bound():
+    """Metrics with fixed labels, see Metrics.bind."""
+
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+
+    def incr(self, name, value=1, **labels):
+        self.metrics.incr(name, value, **dict(self.labels, **labels))
+
+    def observe(self, name, value, **labels):
+        self.metrics.observe(name, value, **dict(self.labels, **labels))
+
+    def timer(self, name, **labels):
+        return Timer(self.metrics, name, dict(self.labels, **labels))
+
+    def bind(self, **labels):
+        return Bound(self.metrics, dict(self.labels, **labels))
+
+
+class Timer():
+    """Context manager reporting the duration of its block, see
+    Metrics.timer."""
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class StatsdExporter():
+    """Metrics hook sending values to a StatsD server over UDP:
+
+        metrics.registry.hooks.append(StatsdExporter("localhost", 8125))
+
+    Histograms of durations are sent as timings in milliseconds. Labels are
+    sent as DogStatsD tags if tags is True, otherwise they are ignored.
+    """
+
+    def __init__(self, host="localhost", port=8125, prefix="ihr", tags=False):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.tags = tags
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, kind, name, value, labels):
+        if kind == "counter":
+            line = "{}.{}:{}|c".format(self.prefix, name, value)
+        elif name.endswith("_seconds"):
+            line = "{}.{}:{:.3f}|ms".format(self.prefix, name[:-len("_seconds")], 1000 * value)
+        else:
+            line = "{}.{}:{}|h".format(self.prefix, name, value)
+        if self.tags and labels:
+            line += "|#" + ",".join("{}:{}".format(*item) for item in sorted(labels.items()))
+
+        try:
+            self.socket.sendto(line.encode("utf-8"), self.address)
+        except OSError as error:
+            logging.debug("Could not send metrics to StatsD: {}".format(error))
+
+
+def serve_prometheus(port=9100, metrics=None, address=""):
+    """Serve the metrics (default registry) for Prometheus on the given port
+    in a background thread, returns the HTTP server."""
+
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    metrics = metrics or registry
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = metrics.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Shared by all clients unless another instance is given
+registry = Metrics()
@@ -0,0 +1,186 @@
+import sys
+import math
+import time
+from collections.abc import Mapping
+from functools import lru_cache
+from ihr.cache import timestamp
+
+# Format of times returned by dictionary access to records, sub-second
+# times also have microseconds (as the API)
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+@lru_cache(maxsize=65536)
+def format_time(value):
+    """Return the API representation of a timestamp (in seconds, int or
+    float), memoized so that records of the same timebin share the same
+    string."""
+
+    seconds = math.floor(value)
+    micro = round((value - seconds) * 1e6)
+    if micro == 1000000:
+        seconds, micro = seconds + 1, 0
+    text = time.strftime(TIME_FORMAT, time.gmtime(seconds))
+    if micro:
+        text += ".{:06d}".format(micro)
+    return text + "Z"
+
+
+def to_timestamp(value):
+    """Return the timestamp of an API time, an int unless it has a fraction
+    of second."""
+
+    value = timestamp(value)
+    return int(value) if value.is_integer() else value
+
+
+class Record(Mapping):
+    """Compact read-only result, with one slot per field instead of a
+    dictionary.
+
+    Fields are attributes, time fields are stored as timestamps (in seconds,
+    integers unless they have a fraction of second). Records are also
+    read-only mappings behaving like the dictionaries returned by the API, so
+    code written for dictionaries keeps working: record["asn"],
+    record.get("asn_name"), dict(record), json.dumps and comparison with
+    dictionaries. Dictionary access returns time fields as ISO 8601 UTC
+    strings (see TIME_FORMAT).
+
+        for res in hege.iter_records():
+            res.asn, res.timebin    # 2497, 1536969600
+            res["timebin"]          # "2018-09-15T00:00:00Z"
+
+    Record classes are created for each endpoint and set of fields, see
+    record_class.
+    """
+
+    __slots__ = ()
+    fields = ()
+    time_fields = frozenset()
+
+    def __getitem__(self, field):
+        if field not in self.fields:
+            raise KeyError(field)
+        value = getattr(self, field)
+        if field in self.time_fields and value is not None:
+            return format_time(value)
+        return value
+
+    def __contains__(self, field):
+        return field in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(field, getattr(self, field)) for field in self.fields))
+
+    def __reduce__(self):
+        return make_record, (type(self).__name__, self.fields, tuple(self.time_fields),
+                             tuple(getattr(self, field) for field in self.fields))
+
+    def to_dict(self):
+        """Return the result as a dictionary, as returned by the API."""
+
+        return {field: self[field] for field in self.fields}
+
+    # Used by ujson to serialize records
+    toDict = to_dict
+
+
+@lru_cache(maxsize=None)
+def record_class(name, fields, time_fields=()):
+    """Return the record class with the given name and fields (tuple of field
+    names in the order of the API results), created on first use.
+
+    :returns: Record subclass, or None if some field names can't be
+    attributes.
+    """
+
+    reserved = set(dir(Record))
+    if not all(field.isidentifier() and field not in reserved for field in fields):
+        return None
+
+    return type(name, (Record,), {
+        "__module__": __name__,
+        "__slots__": fields,
+        "fields": fields,
+        "time_fields": frozenset(time_fields) & frozenset(fields),
+    })
+
+
+def make_record(name, fields, time_fields, values):
+    """Create a record from the values of its slots, used for pickling."""
+
+    cls = record_class(name, fields, time_fields)
+    record = cls.__new__(cls)
+    for field, value in zip(fields, values):
+        setattr(record, field, value)
+    return record
+
+
+class RecordFactory():
+    """Convert results (dictionaries) of an endpoint to records.
+
+    Repeated values are shared: strings (e.g. asn_name) are interned and
+    integers (e.g. ASNs) are deduplicated, so that each distinct value is
+    stored once instead of once per record. Results with field names that
+    can't be attributes are returned unchanged.
+    """
+
+    def __init__(self, name, time_fields=("timebin",)):
+        """
+        :name: Name of the record classes, e.g. HegemonyRecord.
+        :time_fields: Fields stored as timestamps.
+        """
+
+        self.name = name
+        self.time_fields = tuple(time_fields)
+        # Integer values already seen, ints are not interned by Python
+        self.values = {}
+        # Fields of the last results, and their record class and slots
+        self.fields = None
+        self.cls = None
+        self.setters = ()
+
+    def _prepare(self, fields):
+        self.fields = fields
+        self.cls = record_class(self.name, fields, self.time_fields)
+        if self.cls is not None:
+            self.setters = [(getattr(self.cls, field).__set__, field in self.cls.time_fields)
+                            for field in fields]
+
+    def convert(self, results):
+        """Return the list of records of the given list of results."""
+
+        values = self.values
+        records = []
+        for res in results:
+            if not isinstance(res, dict):
+                records.append(res)
+                continue
+            fields = tuple(res)
+            if fields != self.fields:
+                self._prepare(fields)
+            if self.cls is None:
+                records.append(res)
+                continue
+
+            record = self.cls.__new__(self.cls)
+            for (setter, is_time), value in zip(self.setters, res.values()):
+                if value is not None:
+                    kind = type(value)
+                    if is_time:
+                        value = to_timestamp(value)
+                    elif kind is str:
+                        value = sys.intern(value)
+                    elif kind is int:
+                        value = values.setdefault(value, value)
+                setter(record, value)
+            records.append(record)
+
+        return records
@@ -0,0 +1,503 @@
+import math
+import time
+import heapq
+import random
+import logging
+import itertools
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import wait, FIRST_COMPLETED
+from requests.exceptions import RequestException
+from ihr import metrics as ihr_metrics
+
+
+def page_length(results):
+    """Return the number of results of a decoded page, given as a list of
+    results or a dictionary of numpy arrays (see ihr.decode). Return None for
+    streamed pages (see stream_task)."""
+
+    if isinstance(results, list):
+        return len(results)
+    if isinstance(results, dict):
+        return len(next(iter(results.values()), ()))
+    return None
+
+
+class FetchError(Exception):
+    """Raised once all results are returned if some pages could not be
+    downloaded, results of the corresponding queries are incomplete."""
+
+    def __init__(self, pages):
+        """
+        :pages: List of (key, start, end, page) tuples of the failed pages.
+        """
+
+        self.pages = pages
+        super().__init__("{} page(s) failed: {}".format(len(pages), ", ".join(
+            "{} page {}".format(key, page) for key, start, end, page in pages)))
+
+
+def check(queries):
+    """Raise FetchError if some pages of the given queries failed."""
+
+    pages = [(leaf.key, leaf.start, leaf.end, page)
+             for query in queries for leaf in query.leaves() for page in leaf.failed]
+    if pages:
+        raise FetchError(pages)
+
+
+def retry_after(resp):
+    """Return the delay in seconds requested by the Retry-After header of the
+    given response, or None."""
+
+    value = getattr(resp, "headers", {}).get("Retry-After")
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = parsedate_to_datetime(value)
+        return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class Concurrency():
+    """Adaptive limit of the number of requests in flight (AIMD).
+
+    The limit grows by about one request per round trip while the API answers
+    quickly, and is halved when the API throttles (429) or fails (5xx,
+    network errors). It stops growing when latency is well above the fastest
+    recent responses, i.e. when the API is slowing down.
+    """
+
+    def __init__(self, initial=2, maximum=16, minimum=1, decrease=0.5, slow=3.0):
+        """
+        :initial: Initial limit.
+        :maximum: Maximum limit.
+        :minimum: Minimum limit.
+        :decrease: Factor applied to the limit on errors.
+        :slow: Latency ratio (compared to the fastest recent responses) above
+        which the limit stops growing.
+        """
+
+        self.limit = float(initial)
+        self.maximum = max(maximum, initial)
+        self.minimum = minimum
+        self.decrease = decrease
+        self.slow = slow
+        self.baseline = None
+        self.decreased = 0.0
+
+    @property
+    def value(self):
+        """Current number of requests allowed in flight."""
+
+        return int(max(self.minimum, min(self.maximum, self.limit)))
+
+    def success(self, latency):
+        """Update the limit after a successful response."""
+
+        # The baseline slowly drifts up so that a few unusually fast responses
+        # (e.g. empty pages) don't hold back the limit forever
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            self.baseline *= 1.01
+
+        if latency <= self.slow * self.baseline:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def failure(self, sent):
+        """Update the limit after a failed request sent at the given time
+        (time.monotonic)."""
+
+        # Requests sent before the last decrease don't reflect the new limit
+        if sent < self.decreased:
+            return
+
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        self.decreased = time.monotonic()
+        logging.warning("API errors, reducing concurrency to {}".format(self.value))
+
+
+class Query():
+    """Paginated API query, for example one ASN and one time window."""
+
+    def __init__(self, submit, key=None, start=None, end=None):
+        """
+        :submit: Function taking a page number and returning a future for the
+        corresponding API response.
+        :key: Query key (e.g. origin AS and AS), for the caller's use.
+        :start: Start of the queried time window.
+        :end: End of the queried time window.
+        """
+
+        self.submit = submit
+        self.key = key
+        self.start = start
+        self.end = end
+        self.nb_pages = None
+        self.nb_done = 0
+        # Pages that could not be downloaded
+        self.failed = []
+        # True if there is nothing to fetch (see Client.query_params)
+        self.invalid = False
+        # ShardWriter caching the results, also used to resume the query
+        self.writer = None
+        # Function taking the query, its number of results and page size, and
+        # returning the queries replacing it or None (see Client.split)
+        self.split = None
+        # Queries replacing this one (time slices) and the query this one
+        # replaces
+        self.parts = None
+        self.parent = None
+
+    @property
+    def complete(self):
+        """True once all pages of the query (or of its parts) have been
+        returned by the scheduler."""
+
+        if self.parts is not None:
+            return all(part.complete for part in self.parts)
+        return self.nb_pages is not None and self.nb_done == self.nb_pages
+
+    @property
+    def root(self):
+        """Query initially submitted to the scheduler."""
+
+        query = self
+        while query.parent is not None:
+            query = query.parent
+        return query
+
+    def leaves(self):
+        """Yield the queries actually fetched for this query, in time
+        order."""
+
+        if self.parts is None:
+            yield self
+            return
+        for part in self.parts:
+            for leaf in part.leaves():
+                yield leaf
+
+
+class PageScheduler():
+    """Fetch all pages of several queries with a bounded number of requests in
+    flight.
+
+    The number of requests in flight adapts to the API latency and errors
+    (see Concurrency). Failed requests (network errors, 429 and 5xx
+    responses, invalid JSON) are retried with exponential backoff and jitter,
+    or after the delay given by the Retry-After header. Pages failing after
+    all retries are added to Query.failed. Pages checkpointed by the query
+    writer (see ShardWriter) are not downloaded again.
+
+    Queries with too many pages can be split in time slices (see Query.split)
+    once their first page gives the number of results. The slices replace the
+    query, so that no query goes deep in pagination and slices of a large
+    query are fetched concurrently.
+
+    First pages of all queries are submitted right away (up to the in-flight
+    limit) and the remaining pages of a query are submitted as soon as its
+    first page gives the number of results (and the page size is known, see
+    page_size for streamed pages). Follow-up pages take precedence
+    over first pages of other queries so that started queries are completed
+    (and cached) first.
+    """
+
+    # Exceptions raised by futures for failed requests
+    errors = (RequestException,)
+
+    def __init__(self, queries, concurrency=4, ordered=False, retries=5,
+                 backoff=0.5, max_backoff=60, metrics=None, max_buffered=None,
+                 page_size=None):
+        """
+        :queries: List of Query objects.
+        :concurrency: Concurrency instance, or maximum number of requests
+        submitted at once.
+        :ordered: If True pages are returned in the order of the queries and
+        page numbers, otherwise pages are returned as soon as they are
+        downloaded.
+        :retries: Maximum number of retries per page.
+        :backoff: Base delay (seconds) before retrying a request, doubled
+        after each attempt.
+        :max_backoff: Maximum delay before retrying a request.
+        :metrics: Metrics (see ihr.metrics) reporting requests, retries, queue
+        times and pages per query, default is ihr.metrics.registry.
+        :max_buffered: In ordered mode, maximum number of downloaded pages
+        waiting for their turn. Once reached only the next page in line is
+        requested, so that a slow query doesn't make the scheduler download
+        (and keep in memory) all other results. Default is no limit.
+        :page_size: Function returning the number of results per page, or
+        None if it is not known yet. Used to count the pages of streamed
+        queries, whose first page size is unknown until it is decoded.
+        """
+
+        if not isinstance(concurrency, Concurrency):
+            concurrency = Concurrency(concurrency, concurrency, concurrency)
+        self.queries = list(queries)
+        self.concurrency = concurrency
+        self.ordered = ordered
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_buffered = max_buffered
+        self.page_size = page_size
+        self.metrics = metrics or ihr_metrics.registry
+        # (query, page, attempt, time queued) tuples
+        now = time.monotonic()
+        self.pending = deque((query, 1, 0, now) for query in self.queries)
+        # Heap of (time, counter, query, page, attempt) retries
+        self.delayed = []
+        self.counter = itertools.count()
+        self.in_flight = {}
+        # Pages restored from checkpoints, (query, page, response) tuples
+        self.restored = []
+        # State of the ordered mode
+        self.buffered = {}
+        self.next_query = 0
+        self.next_page = 1
+
+    def fill(self):
+        """Submit pending requests until the in-flight limit is reached."""
+
+        # Retries that are due take precedence
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, query, page, attempt = heapq.heappop(self.delayed)
+            self.pending.appendleft((query, page, attempt, now))
+
+        while self.pending and \
+                len(self.in_flight) + len(self.restored) < self.concurrency.value:
+            if self.full():
+                # Backpressure, only the page the caller waits for is sent
+                item = self.next_in_line()
+                if item is None:
+                    break
+            else:
+                item = self.pending.popleft()
+            query, page, attempt, queued = item
+            if query.writer is not None:
+                resp = query.writer.load(query, page)
+                if resp is not None:
+                    self.restored.append((query, page, resp))
+                    continue
+
+            self.metrics.observe("queue_seconds", time.monotonic() - queued)
+            future = query.submit(page)
+            if future is None:
+                # Invalid query (e.g. missing ASN), there is nothing to fetch
+                query.invalid = True
+                query.nb_pages = query.nb_pages or page
+                query.nb_done += 1
+                continue
+            self.in_flight[future] = (query, page, attempt, time.monotonic())
+
+    def full(self):
+        """Return True if the maximum number of buffered pages is reached,
+        counting the pages in flight."""
+
+        if not self.ordered or self.max_buffered is None:
+            return False
+        return len(self.buffered) + len(self.in_flight) + len(self.restored) \
+            >= self.max_buffered
+
+    def next_in_line(self):
+        """Remove and return the pending request of the next page to return in
+        ordered mode, None if it is not pending (e.g. already in flight)."""
+
+        if self.next_query >= len(self.queries):
+            return None
+        query = self.queries[self.next_query]
+        for i, item in enumerate(self.pending):
+            if item[0] is query and item[1] == self.next_page:
+                del self.pending[i]
+                return item
+        return None
+
+    def timeout(self):
+        """Return the number of seconds until the next retry is due, or None
+        if there is no delayed retry."""
+
+        if not self.delayed:
+            return None
+        return max(0.0, self.delayed[0][0] - time.monotonic())
+
+    def _retry(self, query, page, attempt, resp):
+        """Schedule another attempt of a failed request. Return False if the
+        request should not be retried."""
+
+        status = getattr(resp, "status_code", None)
+        if status is not None and 400 <= status < 500 and status not in (408, 429):
+            # Client error (e.g. 404), retrying would not help
+            return False
+        if attempt >= self.retries:
+            return False
+
+        delay = retry_after(resp)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        logging.warning("Retrying {}, page={} in {:.1f}s (status={})".format(
+            query.key, page, delay, status))
+        self.metrics.incr("retries", status=status or "error")
+        heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.counter),
+                                      query, page, attempt + 1))
+        return True
+
+    def _process(self, query, page, resp):
+        """Update the query state with the given response and schedule the
+        remaining pages after the first one."""
+
+        data = getattr(resp, "data", {})
+        if resp is None or not resp.ok or "results" not in data:
+            logging.error("Failed to fetch {}, page={}".format(query.key, page))
+            self.metrics.incr("failed_pages")
+            query.failed.append(page)
+            # Remaining pages are unknown
+            if query.nb_pages is None:
+                query.nb_pages = page
+            return
+
+        size = page_length(data["results"])
+        if size is None and self.page_size is not None:
+            # Streamed page (see stream_task), its size is unknown until
+            # results are decoded but other pages have the same size
+            size = self.page_size()
+
+        if page == 1 and query.split is not None and data.get("next"):
+            parts = query.split(query, data.get("count", 0), size)
+            if parts:
+                self._replace(query, parts)
+                return
+
+        if query.nb_pages is not None:
+            # Follow-up page, already counted
+            return
+        if not data.get("next"):
+            query.nb_pages = page
+            return
+        if not size:
+            # The page size is not known yet, pages are requested one after
+            # the other until it is
+            self.pending.appendleft((query, page + 1, 0, time.monotonic()))
+            return
+
+        query.nb_pages = max(page, int(math.ceil(data["count"] / size)))
+        logging.info("{} more pages to query".format(query.nb_pages - page))
+        # Keep page order while giving priority to follow-up pages
+        now = time.monotonic()
+        self.pending.extendleft(
+            (query, p, 0, now) for p in range(query.nb_pages, page, -1))
+
+    def _replace(self, query, parts):
+        """Replace the given query by the given queries (see Query.split)."""
+
+        logging.info("splitting {} in {} time slices".format(query.key, len(parts)))
+        query.parts = parts
+        for part in parts:
+            part.parent = query
+        index = self.queries.index(query)
+        self.queries[index:index + 1] = parts
+        now = time.monotonic()
+        self.pending.extendleft((part, 1, 0, now) for part in reversed(parts))
+
+    def _collect(self, done):
+        """Process completed requests, submit the next ones and return the
+        list of (query, page, response) tuples ready to be returned. The
+        caller increments query.nb_done when returning a page."""
+
+        ready = []
+        completed, self.restored = self.restored, []
+        for future in done:
+            query, page, attempt, sent = self.in_flight.pop(future)
+            try:
+                resp = future.result()
+            except self.errors as error:
+                logging.warning("Request failed for {}, page={}: {}".format(
+                    query.key, page, error))
+                resp = None
+
+            # Pages served from memory say nothing about the API latency
+            fetched = resp is not None and not getattr(resp, "from_cache", False)
+            if fetched:
+                elapsed = getattr(resp, "elapsed", None)
+                latency = time.monotonic() - sent if elapsed is None else elapsed.total_seconds()
+                self.metrics.incr("requests", status=resp.status_code)
+                self.metrics.observe("request_seconds", latency)
+            elif resp is None:
+                self.metrics.incr("requests", status="error")
+
+            if resp is not None and resp.ok and "results" in getattr(resp, "data", {}):
+                if fetched:
+                    self.concurrency.success(latency)
+            else:
+                if resp is None or resp.status_code == 429 or resp.status_code >= 500:
+                    self.concurrency.failure(sent)
+                if self._retry(query, page, attempt, resp):
+                    if resp is not None:
+                        resp.close()
+                    continue
+            completed.append((query, page, resp))
+
+        for query, page, resp in completed:
+            self._process(query, page, resp)
+            if query.parts is not None:
+                # The page is dropped, results are fetched by the slices
+                resp.close()
+                continue
+            if self.ordered:
+                self.buffered[(id(query), page)] = (query, page, resp)
+            else:
+                ready.append((query, page, resp))
+
+        # Release buffered pages that are next in line
+        while self.ordered and self.next_query < len(self.queries):
+            query = self.queries[self.next_query]
+            if query.complete and self.next_page == 1:
+                self.next_query += 1
+                continue
+            item = self.buffered.pop((id(query), self.next_page), None)
+            if item is None:
+                break
+            ready.append(item)
+            self.next_page += 1
+            if query.nb_pages is not None and self.next_page > query.nb_pages:
+                self.next_query += 1
+                self.next_page = 1
+
+        self.fill()
+        return ready
+
+    def _returned(self, query):
+        """Count a page returned to the caller."""
+
+        query.nb_done += 1
+        root = query.root
+        if root.complete:
+            self.metrics.observe("query_pages", sum(leaf.nb_pages or 0
+                                                    for leaf in root.leaves()))
+
+    def __iter__(self):
+        """Yield (query, page, response) tuples until all pages are
+        received."""
+
+        self.fill()
+        while self.in_flight or self.delayed or self.restored:
+            done = ()
+            if self.restored:
+                pass
+            elif self.in_flight:
+                done, _ = wait(list(self.in_flight), timeout=self.timeout(),
+                               return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(self.timeout())
+            for query, page, resp in self._collect(done):
+                self._returned(query)
+                yield query, page, resp
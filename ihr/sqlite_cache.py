@@ -0,0 +1,337 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+import itertools
+import ujson as json
+import arrow
+from ihr.cache import ShardCache, Entry, cache_size, key_name, timestamp
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    endpoint TEXT NOT NULL,
+    af INTEGER,
+    key1,
+    key2,
+    time INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_key1 ON results (endpoint, af, key1, time);
+CREATE INDEX IF NOT EXISTS results_key2 ON results (endpoint, af, key2, time);
+CREATE TABLE IF NOT EXISTS coverage (
+    endpoint TEXT NOT NULL,
+    key TEXT NOT NULL,
+    day TEXT NOT NULL,
+    PRIMARY KEY (endpoint, key, day)
+);
+"""
+
+# Columns added to the coverage table, written and last used times
+COVERAGE_COLUMNS = ("stored", "used")
+
+# Columns storing the values of query key fields
+KEY_COLUMNS = ("key1", "key2")
+
+
+class SQLiteCache(ShardCache):
+    """Cache of API results stored in a SQLite database (cache_dir/cache.sqlite).
+
+    Results are indexed by endpoint, address family, query key fields (e.g.
+    origin AS and AS, up to two fields) and time. The days fetched for each
+    query key are recorded in a coverage table, so the cache knows exactly
+    which days are missing for a query. Entries of the cache (for eviction
+    and maintenance, see ShardCache.prune) are days of an endpoint.
+
+    A query key is also answered from broader cached queries, for example
+    dependencies of origin AS 2907 to AS 2497 are selected from the cached
+    results of origin AS 2907 with all its dependencies.
+    """
+
+    def __init__(self, cache_dir="cache/", ttl=None, max_size=None):
+        """
+        :cache_dir: Directory of the database and temporary files.
+        :ttl: Expiration rules of recent days, see ShardCache.ttl.
+        :max_size: Maximum size of the database in bytes, by default the
+        cache is never pruned.
+        """
+
+        self.cache_dir = cache_dir
+        if ttl is not None:
+            self.ttl = ttl
+        self.max_size = max_size
+        self.fname = os.path.join(cache_dir, "cache.sqlite")
+        self.size = cache_size(self.fname)
+        # sqlite3 connections can't be shared between threads
+        self.local = threading.local()
+
+    @property
+    def db(self):
+        """Connection to the database for the current thread."""
+
+        if getattr(self.local, "db", None) is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.local.db = sqlite3.connect(self.fname, timeout=60)
+            self.local.db.execute("PRAGMA journal_mode=WAL")
+            self.local.db.executescript(SCHEMA)
+            columns = [row[1] for row in self.local.db.execute("PRAGMA table_info(coverage)")]
+            for column in COVERAGE_COLUMNS:
+                if column not in columns:
+                    try:
+                        self.local.db.execute(
+                            "ALTER TABLE coverage ADD COLUMN {} REAL".format(column))
+                    except sqlite3.OperationalError:
+                        # Added by another process sharing the cache
+                        pass
+        return self.local.db
+
+    @staticmethod
+    def _split(key):
+        """Split a query key in its (field, value) pairs and address family."""
+
+        fields = [(field, value) for field, value in key if field != "af"]
+        af = dict(key).get("af")
+        if len(fields) > len(KEY_COLUMNS):
+            raise ValueError("Too many key fields: {}".format(key))
+        return fields, af
+
+    def _covering(self, key):
+        """Return names of query keys whose results include those of the
+        given key, i.e. with the same values or None (all values)."""
+
+        fields, af = self._split(key)
+        choices = [[(field, value)] if value is None else [(field, value), (field, None)]
+                   for field, value in fields]
+        return [key_name(list(pairs) + [("af", af)])
+                for pairs in itertools.product(*choices)]
+
+    def _where(self, endpoint, key, start, end):
+        """Return the SQL condition and parameters selecting results of the
+        given query key between start (included) and end (excluded)."""
+
+        fields, af = self._split(key)
+        where = ["endpoint=?", "af IS ?", "time>=?", "time<?"]
+        params = [endpoint, af, int(timestamp(start)), int(timestamp(end))]
+        for column, (field, value) in zip(KEY_COLUMNS, fields):
+            if value is not None:
+                values = self._values(value)
+                where.append("{} IN ({})".format(column, ",".join("?" * len(values))))
+                params.extend(values)
+
+        return " AND ".join(where), params
+
+    @staticmethod
+    def _values(value):
+        """Return the values of the results table matching a query key value.
+        Results have the values of the API (e.g. int ASNs) but keys may be
+        given as strings (e.g. asns=["2907"]), see ihr.cache.match_value."""
+
+        if isinstance(value, str):
+            try:
+                return [value, int(value)]
+            except ValueError:
+                return [value]
+        if isinstance(value, int):
+            return [value, str(value)]
+        return [value]
+
+    def has(self, endpoint, key, day):
+        """Return True if results for the given query key and day are in the
+        cache."""
+
+        names = self._covering(key)
+        cursor = self.db.execute(
+            "SELECT stored FROM coverage WHERE endpoint=? AND day=? AND key IN ({})".format(
+                ",".join("?" * len(names))),
+            [endpoint, day.format("YYYY-MM-DD")] + names)
+        # Days stored by older versions never expire
+        return any(stored is None or not self.expired(day, stored)
+                   for stored, in cursor)
+
+    def touch(self, endpoint, key, day):
+        """Mark the given query key and day as used, see prune."""
+
+        names = self._covering(key)
+        with self.db:
+            self.db.execute(
+                "UPDATE coverage SET used=? WHERE endpoint=? AND day=? AND key IN ({})".format(
+                    ",".join("?" * len(names))),
+                [time.time(), endpoint, day.format("YYYY-MM-DD")] + names)
+
+    def read_batches(self, endpoint, key, day, batch_size=1000):
+        """Yield cached results of the given query key and day in lists of at
+        most batch_size results."""
+
+        where, params = self._where(endpoint, key, day, day.shift(days=1))
+        cursor = self.db.execute(
+            "SELECT data FROM results WHERE {} ORDER BY time, rowid".format(where),
+            params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [json.loads(data) for data, in rows]
+
+    def read(self, endpoint, key, day):
+        """Return cached results of the given query key and day."""
+
+        results = []
+        for batch in self.read_batches(endpoint, key, day, 100000):
+            results.extend(batch)
+        return results
+
+    def read_columns(self, endpoint, key, day, columns):
+        """Return cached results of the given query key and day as numpy
+        arrays, see ihr.columns."""
+
+        from ihr.columns import to_columns
+
+        return to_columns(self.read(endpoint, key, day), columns)
+
+    def signature(self, endpoint, key, day):
+        """Return a (signature, size) tuple for the given query key and day,
+        see ShardCache.signature."""
+
+        where, params = self._where(endpoint, key, day, day.shift(days=1))
+        size, = self.db.execute(
+            "SELECT COALESCE(SUM(LENGTH(data)), 0) FROM results WHERE {}".format(where),
+            params).fetchone()
+        # Changes when the day is fetched again
+        names = self._covering(key)
+        stored, = self.db.execute(
+            "SELECT MAX(stored) FROM coverage WHERE endpoint=? AND day=? AND key IN ({})".format(
+                ",".join("?" * len(names))),
+            [endpoint, day.format("YYYY-MM-DD")] + names).fetchone()
+        return (os.path.abspath(self.fname), endpoint, key_name(key),
+                day.format("YYYY-MM-DD"), stored), size
+
+    def store(self, endpoint, key, day, lines, time_field):
+        """Store results (iterable of JSON strings) of the given query key and
+        day. Results previously stored for this key and day (or a subset of
+        it) are replaced."""
+
+        fields, af = self._split(key)
+        where, params = self._where(endpoint, key, day, day.shift(days=1))
+
+        def rows():
+            for line in lines:
+                res = json.loads(line)
+                values = [res.get(field) for field, _ in fields]
+                values += [None] * (len(KEY_COLUMNS) - len(values))
+                yield [endpoint, af] + values + [int(timestamp(res[time_field])), line]
+
+        with self.db:
+            self.db.execute("DELETE FROM results WHERE {}".format(where), params)
+            self.db.executemany(
+                "INSERT INTO results (endpoint, af, key1, key2, time, data) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows())
+            self.db.execute(
+                "INSERT OR REPLACE INTO coverage (endpoint, key, day, stored, used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (endpoint, key_name(key), day.format("YYYY-MM-DD"), time.time(), time.time()))
+
+        # Leave some room to avoid pruning after each store
+        if self.max_size is not None and self.usage() > max(
+                self.max_size, self.size.pruned + 0.1 * self.max_size):
+            self.prune(max_size=int(0.9 * self.max_size))
+
+    def entries(self, endpoint=None):
+        """Yield the cached days of the given endpoint, or of all endpoints,
+        see Entry. Keys are the number of query keys covering the day, days
+        with results but no coverage (e.g. expired) have no keys."""
+
+        where, params = ("WHERE endpoint=?", [endpoint]) if endpoint is not None else ("", [])
+        days = {}
+        for name, day, size in self.db.execute(
+                "SELECT endpoint, time / 86400, SUM(LENGTH(data)) FROM results {} "
+                "GROUP BY endpoint, time / 86400".format(where), params).fetchall():
+            days[name, arrow.get(day * 86400).format("YYYY-MM-DD")] = [0, size, 0, 0]
+        for name, day, keys, used, written in self.db.execute(
+                "SELECT endpoint, day, COUNT(*), MAX(COALESCE(used, stored, 0)), "
+                "MIN(COALESCE(stored, 0)) FROM coverage {} GROUP BY endpoint, day".format(
+                    where), params).fetchall():
+            size = days.get((name, day), [0, 0])[1]
+            days[name, day] = [keys, size, used, written]
+
+        for (name, day), (keys, size, used, written) in sorted(days.items()):
+            yield Entry(name, keys, day, size, used, written)
+
+        # Aggregates are files next to the database, see ShardCache.aggregate
+        if endpoint in (None, self.aggregates):
+            yield from ShardCache.entries(self, self.aggregates)
+
+    def usage(self):
+        """Return the size of the data stored in the database and of the
+        aggregates in bytes."""
+
+        page_size, = self.db.execute("PRAGMA page_size").fetchone()
+        pages, = self.db.execute("PRAGMA page_count").fetchone()
+        free, = self.db.execute("PRAGMA freelist_count").fetchone()
+        return (pages - free) * page_size + sum(
+            entry.size for entry in ShardCache.entries(self, self.aggregates))
+
+    def remove(self, entry):
+        """Remove the results of the given day (see entries)."""
+
+        if entry.endpoint == self.aggregates:
+            ShardCache.remove(self, entry)
+            return
+        start = arrow.get(entry.day)
+        with self.db:
+            self.db.execute("DELETE FROM coverage WHERE endpoint=? AND day=?",
+                            (entry.endpoint, entry.day))
+            self.db.execute(
+                "DELETE FROM results WHERE endpoint=? AND time>=? AND time<?",
+                (entry.endpoint, int(timestamp(start)), int(timestamp(start.shift(days=1)))))
+
+    def prune(self, max_size=None, older_than=None, stale=True, grace=None):
+        """Remove entries from the cache, see ShardCache.prune. Stale query
+        keys are removed from the coverage table, their results are replaced
+        when they are fetched again."""
+
+        nb_stale = 0
+        if stale:
+            recent = time.time() - (self.grace if grace is None else grace)
+            keys = [(endpoint, key, day) for endpoint, key, day, stored in self.db.execute(
+                "SELECT endpoint, key, day, stored FROM coverage WHERE stored IS NOT NULL "
+                "AND COALESCE(used, stored) < ?", (recent,)).fetchall()
+                if self.expired(arrow.get(day), stored)]
+            with self.db:
+                self.db.executemany(
+                    "DELETE FROM coverage WHERE endpoint=? AND key=? AND day=?", keys)
+            nb_stale = len(keys)
+
+        removed, freed = super().prune(max_size, older_than, False, grace)
+        return removed + nb_stale, freed
+
+    def coverage(self, endpoint, key):
+        """Return the sorted list of days (YYYY-MM-DD) cached for the given
+        query key."""
+
+        names = self._covering(key)
+        cursor = self.db.execute(
+            "SELECT DISTINCT day FROM coverage WHERE endpoint=? AND key IN ({}) ORDER BY day".format(
+                ",".join("?" * len(names))), [endpoint] + names)
+        return [day for day, in cursor]
+
+    def missing(self, endpoint, key, start, end):
+        """Return the list of (start, end) time windows that are not in the
+        cache for the given query key."""
+
+        return [(seg_start, seg_end) for cached, seg_start, seg_end
+                in self.plan(endpoint, key, start, end) if not cached]
+
+    def select(self, endpoint, key, start, end):
+        """Yield cached results of the given query key between start and end
+        (included). Days that are not in the cache are ignored, see missing.
+
+        :key: Query key as (field, value) pairs, see Client.cache_key.
+        """
+
+        end = arrow.get(end).shift(seconds=1)
+        where, params = self._where(endpoint, key, start, end)
+        logging.info("select cached results for {}".format(key_name(key)))
+        for data, in self.db.execute(
+                "SELECT data FROM results WHERE {} ORDER BY time, rowid".format(where),
+                params):
+            yield json.loads(data)
@@ -0,0 +1,166 @@
+import json
+import codecs
+from json.decoder import JSONDecodeError
+
+# Size of chunks read from HTTP responses and cache files
+CHUNK_SIZE = 65536
+
+WHITESPACE = " \t\n\r"
+
+
+class JSONStream():
+    """Incremental JSON reader.
+
+    Read JSON values from an iterator of text (or utf-8 bytes) chunks while
+    keeping only the value being decoded in memory.
+    """
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, chunks):
+        """
+        :chunks: Iterator of str or bytes.
+        """
+
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def read(self):
+        """Append the next chunk to the buffer. Returns False at the end of
+        the stream."""
+
+        if self.eof:
+            return False
+
+        # Drop what has already been decoded
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            self.buf += self.utf8.decode(b"", final=True)
+            return False
+
+        if isinstance(chunk, bytes):
+            chunk = self.utf8.decode(chunk)
+        self.buf += chunk
+        return True
+
+    def peek(self):
+        """Skip whitespaces and return the next character."""
+
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read():
+                raise JSONDecodeError("Unexpected end of data", self.buf, self.pos)
+
+    def expect(self, chars):
+        """Consume the next character, it should be one of the given chars."""
+
+        char = self.peek()
+        if char not in chars:
+            raise JSONDecodeError("Expecting one of '{}'".format(chars),
+                                  self.buf, self.pos)
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next JSON value."""
+
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # Numbers and literals may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read()
+
+    def array(self, batch_size=1000):
+        """Decode the next JSON array and yield its elements in lists of at
+        most batch_size elements."""
+
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+
+        batch = []
+        while True:
+            batch.append(self.value())
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+            if self.expect(",]") == "]":
+                break
+
+        if batch:
+            yield batch
+
+
+class PageStream():
+    """Incremental reader of an API page.
+
+    Fields preceding the results (e.g. count and next) are decoded when the
+    object is created. Results are decoded in batches when iterating over the
+    object. Remaining fields are added to self.fields once all results are
+    read.
+    """
+
+    def __init__(self, chunks, batch_size=1000, results="results"):
+        """
+        :chunks: Iterator of str or bytes.
+        :batch_size: Maximum number of results per batch.
+        :results: Name of the results field.
+        """
+
+        self.reader = JSONStream(chunks)
+        self.batch_size = batch_size
+        self.fields = {}
+        self.has_results = False
+
+        self.reader.expect("{")
+        if self.reader.peek() == "}":
+            return
+
+        while True:
+            name = self.reader.value()
+            self.reader.expect(":")
+            if name == results:
+                self.has_results = True
+                return
+            self.fields[name] = self.reader.value()
+            if self.reader.expect(",}") == "}":
+                return
+
+    def __iter__(self):
+        if not self.has_results:
+            return
+
+        for batch in self.reader.array(self.batch_size):
+            yield batch
+
+        while self.reader.expect(",}") == ",":
+            name = self.reader.value()
+            self.reader.expect(":")
+            self.fields[name] = self.reader.value()
+
+
+def iter_array(fp, batch_size=1000):
+    """Decode the JSON array stored in the given file and yield its elements
+    in lists of at most batch_size elements."""
+
+    chunks = iter(lambda: fp.read(CHUNK_SIZE), fp.read(0))
+    return JSONStream(chunks).array(batch_size)
@@ -0,0 +1,180 @@
+import zlib
+import time
+import socket
+import atexit
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests_futures.sessions import FuturesSession
+from urllib3.connection import HTTPConnection
+from urllib3.exceptions import HTTPError
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content encodings accepted from the API, brotli only if it can be decoded
+ENCODINGS = ("gzip", "deflate") + (("br",) if brotli is not None else ())
+DECOMPRESS_ERRORS = (zlib.error,) + ((brotli.error,) if brotli is not None else ())
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTP adapter enabling TCP keep-alive on its connections, so that idle
+    pooled connections are not silently dropped by firewalls and NATs (e.g.
+    between two polls of Client.follow)."""
+
+    socket_options = HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault("socket_options", self.socket_options)
+        super().init_poolmanager(*args, **kwargs)
+
+
+class Transport():
+    """Download threads and HTTP connection pool shared by API clients.
+
+    Connections to the API are kept alive and reused by all clients using
+    the transport, instead of each client opening (and TLS handshaking) its
+    own connections. The connection pool is sized to the number of threads,
+    i.e. the maximum number of concurrent requests. Compressed responses are
+    requested (gzip, and brotli if the brotli package is installed).
+
+    Clients use the process-wide transport (see shared) by default. A
+    transport is also a context manager closing its connections and threads:
+
+        with Transport(max_workers=32) as transport:
+            hege = Hegemony(originasns=2907, start="2018-09-15",
+                            end="2018-09-16", session=transport.session)
+    """
+
+    # Number of hosts with pooled connections
+    pool_connections = 4
+
+    def __init__(self, max_workers=16):
+        """
+        :max_workers: Maximum number of concurrent requests, the pool grows if
+        a client needs more (see reserve).
+        """
+
+        self.lock = threading.Lock()
+        self.max_workers = 0
+        self.closed = False
+        self.executor = None
+        self.session = FuturesSession(executor=self._executor(1))
+        self.session.headers["Accept-Encoding"] = ", ".join(ENCODINGS)
+        self.reserve(max_workers)
+
+    @staticmethod
+    def _executor(max_workers):
+        return ThreadPoolExecutor(max_workers, thread_name_prefix="ihr-http")
+
+    def reserve(self, max_workers):
+        """Make sure that max_workers requests can be sent concurrently."""
+
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("The transport is closed")
+            if max_workers <= self.max_workers:
+                return
+
+            logging.debug("Resize the HTTP transport to {} connections".format(max_workers))
+            old = self.session.executor
+            self.max_workers = max_workers
+            self.executor = self.session.executor = self._executor(max_workers)
+            # Requests already submitted complete in the previous threads
+            old.shutdown(wait=False)
+            for prefix in ("https://", "http://"):
+                adapter = self.session.adapters.get(prefix)
+                self.session.mount(prefix, KeepAliveAdapter(
+                    pool_connections=self.pool_connections, pool_maxsize=max_workers))
+                if adapter is not None:
+                    adapter.close()
+
+    def close(self):
+        """Wait for requests in flight and close all connections."""
+
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_body(resp, metrics=None):
+    """Read the body of a (not yet consumed) response. Compressed bodies are
+    decompressed here rather than by urllib3 so that the compressed size and
+    the decompression time are reported (response_wire_bytes and
+    decompress_seconds metrics)."""
+
+    encoding = resp.headers.get("Content-Encoding", "").strip().lower()
+    if encoding not in ENCODINGS or resp._content_consumed:
+        return resp.content
+
+    try:
+        raw = resp.raw.read(decode_content=False)
+    except HTTPError as error:
+        raise RequestsConnectionError(error, response=resp)
+
+    started = time.perf_counter()
+    try:
+        if encoding == "gzip":
+            body = zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            try:
+                body = zlib.decompress(raw)
+            except zlib.error:
+                # Some servers send raw deflate streams without zlib header
+                body = zlib.decompress(raw, -zlib.MAX_WBITS)
+        else:
+            body = brotli.decompress(raw)
+    except DECOMPRESS_ERRORS as error:
+        raise ValueError("Could not decompress {} response: {}".format(encoding, error))
+
+    if metrics is not None:
+        metrics.incr("response_wire_bytes", len(raw), encoding=encoding)
+        metrics.observe("decompress_seconds", time.perf_counter() - started,
+                        encoding=encoding)
+
+    resp._content = body
+    resp._content_consumed = True
+    return body
+
+
+# Process-wide transport, see shared
+transport = None
+transport_lock = threading.Lock()
+
+
+def shared(max_workers=16):
+    """Return the process-wide transport, able to send at least max_workers
+    concurrent requests."""
+
+    global transport
+    with transport_lock:
+        if transport is None or transport.closed:
+            transport = Transport(max_workers)
+    transport.reserve(max_workers)
+    return transport
+
+
+def close():
+    """Close the process-wide transport. A new one is created by the next
+    client."""
+
+    with transport_lock:
+        if transport is not None:
+            transport.close()
+
+
+atexit.register(close)
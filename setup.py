@@ -13,11 +13,18 @@ setup(
     long_description_content_type="text/markdown",
     author='Romain Fontugne',
     url='https://github.com/InternetHealthReport/abondance',
-    packages=find_packages(exclude=('tests', 'docs')),
+    packages=find_packages(exclude=('tests', 'docs', 'benchmarks')),
     install_requires=[
         'arrow',
         'requests_futures',
         'ujson'
-        ]
+        ],
+    extras_require={
+        'async': ['aiohttp'],
+        'numpy': ['numpy'],
+        },
+    entry_points={
+        'console_scripts': ['abondance=ihr.cli:main'],
+        }
 )
 